@@ -5,12 +5,13 @@ from sanic.worker.loader import AppLoader
 from functools import partial
 
 
-def main(port):
+def main(port, workers):
     loader = AppLoader(factory=partial(create_app))
     app = loader.load()
-    app.prepare(port=port)
+    app.prepare(port=port, workers=workers)
     Sanic.serve(primary=app, app_loader=loader)
     
 port = CONFIG.port
+workers = CONFIG.workers
 
-main(port)
+main(port, workers)
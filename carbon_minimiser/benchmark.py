@@ -0,0 +1,289 @@
+# Copyright 2022 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Benchmarks of the Minimiser queries, the cache refresh and every /optimise route, over synthetic 96 half hour
+forecasts from carbon_api.stub_server. Reports operations per second, latency percentiles and memory allocated
+per call, and saves them as JSON to compare between commits:
+
+python -m carbon_minimiser.benchmark -o after.json --compare before.json
+"""
+from contextlib import redirect_stdout
+from datetime import datetime, UTC
+from itertools import product
+from unittest import mock
+import aiohttp
+import argparse
+import asyncio
+import io
+import json
+import platform
+import socket
+import subprocess
+import time
+import tracemalloc
+from aiohttp.test_utils import TestServer
+from carbon_minimiser.carbon_api.stub_server import SyntheticForecasts, create_stub_app, half_hour, api_time
+from carbon_minimiser.carbon_api.carbon_api_wrapper.carbon import REGIONS
+from carbon_minimiser.minimiser_api.cache import Cache, derive
+from carbon_minimiser.minimiser_api.minimiser import Minimiser
+import carbon_minimiser.config as CONFIG
+
+LOCATIONS = list(REGIONS)
+REGION_COUNTS = [1, 4, 17]
+WINDOWS = [0.5, 4, 24]
+RESULTS = [1, 10]
+RANGES = [[0, 95], [6, 18]]
+# calls traced to measure allocations, which are much slower under tracemalloc
+TRACED_CALLS = 20
+
+
+def synthetic_snapshot(seed=0):
+    """
+    :return: cache snapshot with a 96 half hour forecast for every region, as made by Cache.create_cache
+    """
+    forecasts = SyntheticForecasts(seed)
+    now = half_hour(None)
+    snapshot = {"created": datetime.now().isoformat(), "current_region_intensity": {}, "region_forecast_range": {}}
+    for region, region_id in REGIONS.items():
+        intensity = forecasts.intensity(region_id, now)
+        snapshot["current_region_intensity"][region] = intensity["forecast"], intensity["index"]
+        snapshot["region_forecast_range"][f"('{region}', 47.5)"] = [
+            {"time": api_time(t), **forecasts.intensity(region_id, t)} for t in forecasts.times(now)]
+    return snapshot
+
+
+def summarise(name, params, latencies, elapsed, allocated=None):
+    """
+    :param latencies: seconds taken by each call
+    :param elapsed: seconds taken by all calls, less than their total latency when calls overlap
+    :param allocated: bytes allocated at peak by each traced call
+    """
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return round(latencies[min(int(p / 100 * len(latencies)), len(latencies) - 1)] * 1000, 4)
+    return {"name": name, "params": params, "calls": len(latencies), "ops_per_sec": round(len(latencies) / elapsed, 1),
+            "p50_ms": percentile(50), "p90_ms": percentile(90), "p99_ms": percentile(99), "max_ms": percentile(100),
+            "peak_kib": round(sum(allocated) / len(allocated) / 1024, 2) if allocated else None}
+
+
+async def measure(name, params, call, duration):
+    """
+    Awaits call() repeatedly for duration seconds, then a few more times while tracing allocations
+    """
+    await call()
+    latencies = []
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        began = time.perf_counter()
+        await call()
+        latencies.append(time.perf_counter() - began)
+    elapsed = time.perf_counter() - start
+    allocated = []
+    tracemalloc.start()
+    for _ in range(TRACED_CALLS):
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        await call()
+        allocated.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+    result = summarise(name, params, latencies, elapsed, allocated)
+    print(f"{name} {params}: {result['ops_per_sec']} ops/s, p50 {result['p50_ms']} ms, p99 {result['p99_ms']} ms, "
+          f"{result['peak_kib']} KiB")
+    return result
+
+
+async def bench_queries(duration):
+    snapshot = synthetic_snapshot()
+    results = []
+    for materialise in [False, True]:
+        minimiser = Minimiser()
+        minimiser.cache = Cache(1800)
+        with mock.patch.object(CONFIG, "materialise", materialise):
+            minimiser.cache.cache = derive(snapshot)
+        for regions, window, num_options, time_range in product(REGION_COUNTS, WINDOWS, RESULTS, RANGES):
+            params = {"regions": regions, "window": window, "results": num_options, "range": time_range, "materialise": materialise}
+            results.append(await measure("optimal_time_window_and_location", params,
+                                         lambda: minimiser.optimal_time_window_and_location(LOCATIONS[:regions], window,
+                                                                                            num_options, time_range),
+                                         duration))
+        if not materialise:
+            for regions, num_options, time_range in product(REGION_COUNTS, RESULTS, RANGES):
+                params = {"regions": regions, "results": num_options, "range": time_range}
+                results.append(await measure("optimal_time_and_location", params,
+                                             lambda: minimiser.optimal_time_and_location(LOCATIONS[:regions], num_options,
+                                                                                         time_range),
+                                             duration))
+        await minimiser.close()
+    return results
+
+
+async def bench_refresh(duration):
+    """
+    Full refreshes against the stub server, which answers without delay so only the cache's own work is measured
+    """
+    server = TestServer(create_stub_app())
+    await server.start_server()
+    results = []
+    try:
+        for regions, bulk in product(REGION_COUNTS, [False, True]):
+            with mock.patch.multiple(CONFIG, api_url=str(server.make_url("/")), locations=LOCATIONS[:regions]), \
+                    mock.patch("carbon_minimiser.minimiser_api.cache.LOCATIONS", LOCATIONS[:regions]):
+                cache = Cache(1800, bulk_threshold=0 if bulk else len(LOCATIONS))
+                cache.gather_functions()
+
+                async def refresh():
+                    with redirect_stdout(io.StringIO()):
+                        return await cache.create_cache()
+                results.append(await measure("Cache.create_cache", {"regions": regions, "bulk": bulk}, refresh, duration))
+            await cache.carbonAPI.close()
+    finally:
+        await server.close()
+    return results
+
+
+def route_urls():
+    """
+    :return: dict of each /optimise route to a list of urls calling it with varied parameters
+    """
+    queries = [f"?results={num_options}&range={time_range[0]},{time_range[1]}" for num_options, time_range in product(RESULTS, RANGES)]
+    return {"/optimise": [f"/optimise{q}" for q in queries],
+            "/optimise/location": ["/optimise/location"],
+            "/optimise/location/<location>": [f"/optimise/location/{location}{q}" for location in LOCATIONS[:4] for q in queries],
+            "/optimise/location/<location>/window/<window>": [f"/optimise/location/{location}/window/{window}{q}"
+                                                              for location in LOCATIONS[:4] for window in WINDOWS for q in queries],
+            "/optimise/location/window/<window>": [f"/optimise/location/window/{window}{q}" for window in WINDOWS for q in queries],
+            "/optimise/location/<location>/profile": [f"/optimise/location/{location}/profile?profile=0.5,2,2,2,0.5"
+                                                      for location in LOCATIONS[:4]],
+            "/optimise/location/<location>/slots/<N>": [f"/optimise/location/{location}/slots/8?min_run=2"
+                                                        for location in LOCATIONS[:4]],
+            "/optimise/batch": ["/optimise/batch"],
+            "/optimise/schedule": ["/optimise/schedule"]}
+
+
+ROUTE_BODIES = {
+    "/optimise/batch": [{"location": location, "window": window} for location in LOCATIONS for window in WINDOWS],
+    "/optimise/schedule": {"jobs": [{"window": window, "deadline": 24} for window in WINDOWS] * 20,
+                           "capacity": {location: 2 for location in LOCATIONS}},
+}
+
+
+async def bench_routes(duration, concurrency):
+    """
+    Load test of every /optimise route, served in process by Sanic with the cache injected and requested over
+    HTTP by concurrency clients at once
+    """
+    from carbon_minimiser.minimiser_api.app import create_app
+    # the app's cache is published to directly rather than refreshed
+    caches = []
+    with mock.patch.multiple(CONFIG, cache=True, shared_cache=False, locations=LOCATIONS, snapshot_path=""), \
+            mock.patch("carbon_minimiser.minimiser_api.app.LOCATIONS", LOCATIONS), \
+            mock.patch.object(Cache, "start_caching", lambda self: caches.append(self)):
+        app = create_app()
+        while not caches:
+            await asyncio.sleep(0.01)
+    caches[0].publish(derive(synthetic_snapshot()))
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = await app.create_server(host="127.0.0.1", port=port, return_asyncio_server=True, access_log=False)
+    await server.startup()
+    await server.before_start()
+    await server.after_start()
+    results = []
+    try:
+        async with aiohttp.ClientSession(f"http://127.0.0.1:{port}",
+                                         connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+            for route, urls in route_urls().items():
+                body = ROUTE_BODIES.get(route)
+
+                async def request(url):
+                    method = session.post if body is not None else session.get
+                    async with method(url, json=body) as response:
+                        await response.read()
+                        if response.status != 200:
+                            raise RuntimeError(f"{url} returned {response.status}")
+
+                async def client(offset, latencies, end):
+                    i = offset
+                    while time.perf_counter() < end:
+                        began = time.perf_counter()
+                        await request(urls[i % len(urls)])
+                        latencies.append(time.perf_counter() - began)
+                        i += 1
+                await request(urls[0])
+                latencies = []
+                start = time.perf_counter()
+                await asyncio.gather(*[client(c, latencies, start + duration) for c in range(concurrency)])
+                result = summarise(route, {"concurrency": concurrency, "urls": len(urls)}, latencies, time.perf_counter() - start)
+                print(f"{route}: {result['ops_per_sec']} req/s, p50 {result['p50_ms']} ms, p99 {result['p99_ms']} ms")
+                results.append(result)
+    finally:
+        await server.before_stop()
+        await server.close()
+        await server.wait_closed()
+        await server.after_stop()
+    return results
+
+
+def compare(results, previous):
+    """
+    Prints the change in operations per second of each benchmark also in previous
+    """
+    before = {(r["name"], json.dumps(r["params"], sort_keys=True)): r for r in previous["results"]}
+    for result in results:
+        old = before.get((result["name"], json.dumps(result["params"], sort_keys=True)))
+        if old:
+            change = (result["ops_per_sec"] / old["ops_per_sec"] - 1) * 100
+            print(f"{change:+7.1f}% {result['name']} {result['params']}: {old['ops_per_sec']} -> {result['ops_per_sec']} ops/s")
+
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args):
+    results = []
+    if "queries" in args.suites:
+        results += await bench_queries(args.duration)
+    if "refresh" in args.suites:
+        results += await bench_refresh(args.duration)
+    if "routes" in args.suites:
+        results += await bench_routes(args.duration, args.concurrency)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output', default="benchmark.json", help="file results are saved to")
+    parser.add_argument('--compare', help="results saved by an earlier run, to print the change from")
+    parser.add_argument('--duration', type=float, default=0.5, help="seconds each benchmark runs for")
+    parser.add_argument('--concurrency', type=int, default=16, help="clients requesting each route at once")
+    parser.add_argument('--suites', nargs="+", default=["queries", "refresh", "routes"], choices=["queries", "refresh", "routes"])
+    args = parser.parse_args()
+    results = asyncio.run(run(args))
+    with open(args.output, "w") as f:
+        json.dump({"commit": commit(), "created": datetime.now(UTC).isoformat(), "python": platform.python_version(),
+                   "platform": platform.platform(), "duration": args.duration, "results": results}, f, indent=1)
+    print(f"Saved {len(results)} results to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,55 @@
-from carbon_intensity_exporter.exporter.prometheus import Prometheus
-from prometheus_client import start_http_server
-import time
-from prometheus_client.core import REGISTRY
+# Copyright 2022 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Exports the current carbon intensity of every region, and of Great Britain, as Prometheus metrics,
+along with the latency and errors of the requests made to the Carbon Intensity API to collect them
+"""
+from aiohttp import web
 import argparse
+import carbon_minimiser.config as CONFIG
+from carbon_minimiser.carbon_api.carbon_api_wrapper.carbon import CarbonAPI, REGIONS
+from carbon_minimiser.metrics import CONTENT_TYPE, REGISTRY, Gauge, Registry
+
+
+def create_exporter():
+    carbon = CarbonAPI(CONFIG.api_url, **CONFIG.connection)
+
+    async def metrics(request):
+        async with carbon.snapshot():
+            # both read from one request each, whatever the number of regions
+            regions = await carbon.regions_forecast_single(list(REGIONS), 0) or {}
+            national = await carbon.current_national_intensity()
+        intensities = Registry()
+        Gauge("carbon_intensity_forecast", "Forecast carbon intensity of the current half hour in gCO2/kWh",
+              ["region", "index"], intensities,
+              function=lambda: {(region, index): forecast for region, (forecast, index) in regions.items()})
+        Gauge("carbon_intensity_national_actual", "Carbon intensity of Great Britain in the current half hour in gCO2/kWh",
+              ["index"], intensities,
+              function=lambda: {(national[1],): national[0]} if national and national[0] is not None else {})
+        return web.Response(text=intensities.render() + REGISTRY.render(), headers={"Content-Type": CONTENT_TYPE})
+
+    async def close(app):
+        await carbon.close()
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    app.on_cleanup.append(close)
+    return app
 
 
 def main(port):
-    start_http_server(port)
-    REGISTRY.register(Prometheus())
-    while True:
-        time.sleep(10)
+    web.run_app(create_exporter(), port=port)
 
 
 parser = argparse.ArgumentParser()
@@ -12,24 +12,74 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import aiohttp
+import re
+import time
 from urllib.parse import urljoin
+from carbon_minimiser.metrics import Counter, Histogram
+
+TIMESTAMP = re.compile(r"\d{4}-\d{2}-\d{2}T[^/]+")
+REGION_ID = re.compile(r"regionid/(\d+)")
+REQUEST_SECONDS = Histogram("carbon_api_request_seconds", "Time taken by requests to the Carbon Intensity API",
+                            ["endpoint", "regionid"])
+REQUEST_ERRORS = Counter("carbon_api_request_errors_total", "Failed requests to the Carbon Intensity API",
+                         ["endpoint", "regionid", "reason"])
+
+
+def endpoint_labels(endpoint):
+    """
+    :return: endpoint with any timestamp and region id replaced by placeholders, and the region id
+    """
+    region = REGION_ID.search(endpoint)
+    template = REGION_ID.sub("regionid/{regionid}", TIMESTAMP.sub("{from}", endpoint))
+    return template, region.group(1) if region else ""
 
 
 class ApiConnection:
-    def __init__(self, base):
+    def __init__(self, base, limit=20, limit_per_host=10, dns_cache_ttl=300, keepalive_timeout=60):
         self.base_url = base
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.session = None
+
+    def _session(self):
+        """
+        Returns the pooled session, opening it on first use so it is bound to the running event loop.
+        Connections are kept alive and reused across requests rather than handshaking on every call
+        """
+        if self.session is None or self.session.closed:
+            # issue with ssl certs overridden by ssl=false
+            connector = aiohttp.TCPConnector(ssl=False,
+                                             limit=self.limit,
+                                             limit_per_host=self.limit_per_host,
+                                             ttl_dns_cache=self.dns_cache_ttl,
+                                             keepalive_timeout=self.keepalive_timeout)
+            self.session = aiohttp.ClientSession(connector=connector, trust_env=True)
+        return self.session
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
 
     async def status(self):
-        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False), trust_env=True) as session:
-            async with session.get(self.base_url) as r:
-                return r.status
+        async with self._session().get(self.base_url) as r:
+            return r.status
 
     async def get(self, endpoint):
         url = urljoin(self.base_url, endpoint)
-        # issue with ssl certs overridden by ssl=false
-        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False), trust_env=True) as session:
-            async with session.get(url) as r:
+        labels = endpoint_labels(endpoint)
+        start = time.perf_counter()
+        try:
+            async with self._session().get(url) as r:
                 json = await r.json()
                 if r.status != 200:
                     print(f"Error requesting: {url} Status code: {r.status}")
+                    REQUEST_ERRORS.inc(*labels, r.status)
                 return json
+        except Exception as e:
+            REQUEST_ERRORS.inc(*labels, type(e).__name__)
+            raise
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - start, *labels)
@@ -11,8 +11,12 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from .api_connection import ApiConnection
+from .api_connection import ApiConnection, TIMESTAMP
+from .memo import DocumentMemo
+from contextlib import asynccontextmanager
 from datetime import datetime, UTC
+from itertools import islice
+import asyncio
 
 REGIONS = {
     'N_SCOTLAND': 1, 'S_SCOTLAND': 2, 'NW_ENGLAND': 3, 'NE_ENGLAND': 4, 'YORKSHIRE': 5, 'N_WALES': 6, 'S_WALES': 7,
@@ -21,9 +25,54 @@ REGIONS = {
 }
 
 
+API_URL = "https://api.carbonintensity.org.uk/"
+
+
 class CarbonAPI:
-    def __init__(self):
-        self.api = ApiConnection("https://api.carbonintensity.org.uk/")
+    def __init__(self, url=API_URL, memo_ttl=300, memo_size=256, **connection):
+        """
+        url: base URL of the Carbon Intensity API, or of a stand in such as stub_server
+        memo_ttl, memo_size: bounds of the documents kept outside a snapshot, see DocumentMemo
+        connection: keyword arguments passed on to ApiConnection to size its connection pool
+        """
+        self.api = ApiConnection(url, **connection)
+        self.memo = DocumentMemo(memo_ttl, memo_size)
+        self.documents = None
+        self.now = None
+
+    """
+    Closes the pooled connections to the API, should be awaited on the loop that made the requests
+    """
+    async def close(self):
+        await self.api.close()
+
+    """
+    Within this context each distinct API document is downloaded at most once, and forecasts are requested
+    from a single point in time, so accessors reading the same document share one download
+    """
+    @asynccontextmanager
+    async def snapshot(self):
+        self.documents = {}
+        self.now = datetime.now(UTC).isoformat()
+        try:
+            yield self
+        finally:
+            self.documents = None
+            self.now = None
+
+    def _timestamp(self):
+        return self.now or datetime.now(UTC).isoformat()
+
+    """
+    Outside a snapshot, requests for the same document in the same half hour share one download through the memo,
+    whatever the exact time they ask for forecasts from
+    """
+    async def _fetch(self, endpoint):
+        if self.documents is None:
+            return await self.memo.get(TIMESTAMP.sub("{from}", endpoint), lambda: self.api.get(endpoint))
+        if endpoint not in self.documents:
+            self.documents[endpoint] = asyncio.ensure_future(self.api.get(endpoint))
+        return await self.documents[endpoint]
 
     """
     Returns 1 if 200 response received from API root, else 0
@@ -38,7 +87,7 @@ class CarbonAPI:
     """
     async def current_national_intensity(self):
         try:
-            json = await self.api.get("intensity")
+            json = await self._fetch("intensity")
             intensity = json['data'][0]['intensity']
             return intensity['actual'], intensity['index']
         except KeyError as e:
@@ -52,7 +101,7 @@ class CarbonAPI:
     """
     async def current_region_intensity(self, region):
         try:
-            json = await self.api.get(f"regional/regionid/{REGIONS[region]}")
+            json = await self._fetch(f"regional/regionid/{REGIONS[region]}")
             intensity = json['data'][0]['data'][0]['intensity']
             return intensity['forecast'], intensity['index']
         except KeyError as e:
@@ -65,7 +114,7 @@ class CarbonAPI:
     """
     async def current_national_mix(self):
         try:
-            json = await self.api.get(f"generation")
+            json = await self._fetch(f"generation")
             mix_list = json['data']['generationmix']
             return {mix['fuel']: mix['perc'] for mix in mix_list}
         except KeyError as e:
@@ -78,7 +127,7 @@ class CarbonAPI:
     """
     async def current_region_mix(self, region):
         try:
-            json = await self.api.get(f"regional/regionid/{REGIONS[region]}")
+            json = await self._fetch(f"regional/regionid/{REGIONS[region]}")
             mix_list = json['data'][0]['data'][0]['generationmix']
             return {mix['fuel']: mix['perc'] for mix in mix_list}
         except KeyError as e:
@@ -93,7 +142,7 @@ class CarbonAPI:
     """
     async def national_forecast_single(self, hours):
         try:
-            json = await self.api.get(f"intensity/{datetime.now(UTC).isoformat()}/fw48h")
+            json = await self._fetch(f"intensity/{self._timestamp()}/fw48h")
             # endpoint returns half hourly predictions from current half hour rounded
             # so index 2n gives n hours from now. Max time is therefore 47.5 hours
             index = int(hours*2) if hours < 48 else 95
@@ -111,7 +160,7 @@ class CarbonAPI:
     """
     async def national_forecast_range(self, hours):
         try:
-            json = await self.api.get(f"intensity/{datetime.now(UTC).isoformat()}/fw48h")
+            json = await self._fetch(f"intensity/{self._timestamp()}/fw48h")
             # endpoint returns half hourly predictions from current half hour rounded
             index = int(hours*2) if hours < 48 else 95
             forecasts = json['data'][0: index + 1]
@@ -133,7 +182,7 @@ class CarbonAPI:
     """
     async def region_forecast_single(self, region, hours):
         try:
-            json = await self.api.get(f"regional/intensity/{datetime.now(UTC).isoformat()}/fw48h/regionid/{REGIONS[region]}")
+            json = await self._fetch(f"regional/intensity/{self._timestamp()}/fw48h/regionid/{REGIONS[region]}")
             index = int(hours*2) if hours < 48 else 95
             prediction = json['data']['data'][index]['intensity']
             return prediction['forecast'], prediction['index']
@@ -150,7 +199,7 @@ class CarbonAPI:
     """
     async def region_forecast_range(self, region, hours):
         try:
-            json = await self.api.get(f"regional/intensity/{datetime.now(UTC).isoformat()}/fw48h/regionid/{REGIONS[region]}")
+            json = await self._fetch(f"regional/intensity/{self._timestamp()}/fw48h/regionid/{REGIONS[region]}")
             index = int(hours*2) if hours < 48 else 95
             forecasts = json['data']['data'][0: index + 1]
             predictions = []
@@ -163,3 +212,51 @@ class CarbonAPI:
             print("Failed to collect region forecast range")
             print(e)
             return None
+
+    """
+    regions: list of regions, see REGIONS
+    hours: int or float, should be less than 47.5
+    Given a number of hours, returns a dict of each region's predicted carbon intensity that many hours from now
+    (rounded down to the nearest half hour), read from the single all regions forecast
+    """
+    async def regions_forecast_single(self, regions, hours):
+        try:
+            json = await self._fetch(f"regional/intensity/{self._timestamp()}/fw48h")
+            index = int(hours*2) if hours < 48 else 95
+            names = {REGIONS[region]: region for region in regions}
+            predictions = {}
+            for r in json['data'][index]['regions']:
+                region = names.get(r['regionid'])
+                if region is not None:
+                    predictions[region] = r['intensity']['forecast'], r['intensity']['index']
+            return predictions
+        except KeyError as e:
+            print("Failed to collect regions forecast")
+            print(e)
+            return None
+
+    """
+    regions: list of regions, see REGIONS
+    hours: int or float, max available is 47.5
+    Given a number of hours, returns a dict of each region's predicted carbon intensity at each half hour between now
+    (rounded down to the nearest half hour) and that many hours from now. One request covers every region
+    """
+    async def regions_forecast_range(self, regions, hours):
+        try:
+            json = await self._fetch(f"regional/intensity/{self._timestamp()}/fw48h")
+            index = int(hours*2) if hours < 48 else 95
+            names = {REGIONS[region]: region for region in regions}
+            predictions = {region: [] for region in regions}
+            # single pass over the document, appending straight into each region's forecast
+            for f in islice(json['data'], index + 1):
+                for r in f['regions']:
+                    region = names.get(r['regionid'])
+                    if region is not None:
+                        predictions[region].append({"time": f['from'],
+                                                    "forecast": r["intensity"]["forecast"],
+                                                    "index": r["intensity"]["index"]})
+            return predictions
+        except KeyError as e:
+            print("Failed to collect regions forecast range")
+            print(e)
+            return None
@@ -0,0 +1,68 @@
+# Copyright 2022 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from collections import OrderedDict
+import asyncio
+import time
+
+HALF_HOUR = 1800
+
+
+class DocumentMemo:
+    """
+    API documents shared by every concurrent request for the same one while it is in flight, and then kept until
+    the end of the half hour it was requested in, when the Carbon Intensity API moves on to the next, or for at
+    most ttl seconds. Documents are keyed by the half hour rather than the exact time requested
+    """
+    def __init__(self, ttl=300, size=256):
+        """
+        :param ttl: most seconds a document is kept for, 0 to only share requests in flight
+        :param size: most documents kept, least recently used are dropped first
+        """
+        self.ttl = ttl
+        self.size = size
+        # key to (expiry, document)
+        self.entries = OrderedDict()
+        # key to future of the document being requested
+        self.in_flight = {}
+
+    async def get(self, endpoint, fetch):
+        """
+        :param endpoint: endpoint with any timestamp left out, see CarbonAPI._fetch
+        :param fetch: coroutine function requesting the document
+        """
+        now = time.time()
+        slot = int(now // HALF_HOUR)
+        key = (endpoint, slot)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > now:
+            self.entries.move_to_end(key)
+            return entry[1]
+        future = self.in_flight.get(key)
+        if future is None:
+            future = self.in_flight[key] = asyncio.ensure_future(self._fetch(key, fetch, min((slot + 1) * HALF_HOUR, now + self.ttl)))
+        # a caller giving up does not cancel the request for everyone else waiting on it
+        return await asyncio.shield(future)
+
+    async def _fetch(self, key, fetch, expiry):
+        try:
+            document = await fetch()
+        finally:
+            del self.in_flight[key]
+        # error responses are not kept, see ApiConnection.get
+        if self.ttl > 0 and not (isinstance(document, dict) and "error" in document):
+            self.entries[key] = expiry, document
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return document
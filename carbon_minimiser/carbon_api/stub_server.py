@@ -0,0 +1,197 @@
+# Copyright 2022 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Local stand in for the Carbon Intensity API, serving the documents CarbonAPI reads with a configurable latency,
+error rate and payload size, so the refresh and query paths can be exercised without the real API.
+Run with python -m carbon_minimiser.carbon_api.stub_server and set url in the [CONNECTION] section of config.ini
+to the address it prints
+"""
+from datetime import datetime, timedelta, UTC
+from functools import lru_cache
+from aiohttp import web
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+from carbon_minimiser.carbon_api.carbon_api_wrapper.carbon import REGIONS
+
+FUELS = ["biomass", "coal", "imports", "gas", "nuclear", "other", "hydro", "solar", "wind"]
+# upper bound of each index, roughly the Carbon Intensity API's bands
+INDEXES = [(40, "very low"), (120, "low"), (200, "moderate"), (290, "high"), (math.inf, "very high")]
+SLOTS = 96
+
+
+def half_hour(timestamp):
+    """
+    :return: timestamp rounded down to the half hour, as a UTC datetime
+    """
+    time = datetime.fromisoformat(timestamp.replace("Z", "+00:00")) if timestamp else datetime.now(UTC)
+    time = time.astimezone(UTC) if time.tzinfo else time.replace(tzinfo=UTC)
+    return time.replace(minute=time.minute // 30 * 30, second=0, microsecond=0)
+
+
+def api_time(time):
+    return time.strftime("%Y-%m-%dT%H:%MZ")
+
+
+class SyntheticForecasts:
+    """
+    Deterministic made up intensities following a daily cycle, different for each region,
+    so the same half hour always has the same forecast however it is requested
+    """
+    def __init__(self, seed=0, padding=0):
+        """
+        :param padding: extra bytes added to every document, to test larger payloads
+        """
+        self.seed = seed
+        self.padding = "x" * padding
+
+    def forecast(self, region_id, time):
+        # hashes of numbers are the same in every process, unlike those of strings
+        noise = hash((self.seed, region_id, time.timestamp())) % 41 - 20
+        cycle = math.sin((time.hour + time.minute / 60 - 6) / 24 * 2 * math.pi)
+        return max(0, round(40 + region_id * 11 + 80 * cycle + noise))
+
+    def intensity(self, region_id, time, actual=False):
+        forecast = self.forecast(region_id, time)
+        intensity = {"forecast": forecast, "index": next(index for bound, index in INDEXES if forecast < bound)}
+        if actual:
+            intensity["actual"] = forecast
+        return intensity
+
+    def mix(self, region_id, time):
+        weights = [hash((self.seed, region_id, time.timestamp(), f)) % 19 + 1 for f in range(len(FUELS))]
+        return [{"fuel": fuel, "perc": round(100 * w / sum(weights), 1)} for fuel, w in zip(FUELS, weights)]
+
+    def region(self, region_id):
+        name = next(name for name, i in REGIONS.items() if i == region_id)
+        return {"regionid": region_id, "dnoregion": name, "shortname": name.replace("_", " ").title()}
+
+    def period(self, time):
+        return {"from": api_time(time), "to": api_time(time + timedelta(minutes=30))}
+
+    def document(self, data):
+        document = {"data": data}
+        if self.padding:
+            document["padding"] = self.padding
+        return document
+
+    def national(self, time):
+        return self.document([{**self.period(time), "intensity": self.intensity(0, time, actual=True)}])
+
+    def generation(self, time):
+        return self.document({**self.period(time), "generationmix": self.mix(0, time)})
+
+    def regional(self, region_id, time):
+        return self.document([{**self.region(region_id),
+                               "data": [{**self.period(time), "intensity": self.intensity(region_id, time),
+                                         "generationmix": self.mix(region_id, time)}]}])
+
+    def national_fw48h(self, time):
+        return self.document([{**self.period(t), "intensity": self.intensity(0, t, actual=True)} for t in self.times(time)])
+
+    def regional_fw48h(self, region_id, time):
+        return self.document({**self.region(region_id),
+                              "data": [{**self.period(t), "intensity": self.intensity(region_id, t),
+                                        "generationmix": self.mix(region_id, t)} for t in self.times(time)]})
+
+    def regions_fw48h(self, time):
+        return self.document([{**self.period(t),
+                               "regions": [{**self.region(region_id), "intensity": self.intensity(region_id, t),
+                                            "generationmix": self.mix(region_id, t)} for region_id in REGIONS.values()]}
+                              for t in self.times(time)])
+
+    @staticmethod
+    def times(time):
+        return [time + timedelta(minutes=30 * s) for s in range(SLOTS)]
+
+
+def create_stub_app(latency=0.0, jitter=0.0, error_rate=0.0, padding=0, recorded=None, seed=0):
+    """
+    :param latency: seconds added to every response
+    :param jitter: further seconds of random latency, up to this much
+    :param error_rate: fraction of requests answered with a 500
+    :param padding: extra bytes added to every document
+    :param recorded: directory of documents saved from the real API, served in place of synthetic ones. Each is named
+                     after its endpoint, with any timestamp left out and / replaced by _, as in regional_intensity_fw48h.json
+    :param seed: seed of the synthetic forecasts
+    """
+    forecasts = SyntheticForecasts(seed, padding)
+    chance = random.Random(seed)
+
+    @lru_cache(maxsize=256)
+    def synthetic(name, time, *args):
+        """
+        Serialised document, reused by every request for the same half hour
+        """
+        return json.dumps(getattr(forecasts, name)(*args, time), separators=(",", ":")).encode()
+
+    @lru_cache(maxsize=256)
+    def replay(path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def respond(name, region=False):
+        async def handler(request):
+            await asyncio.sleep(latency + chance.uniform(0, jitter))
+            if chance.random() < error_rate:
+                return web.json_response({"error": {"code": "500 Internal Server Error", "message": "Stub error"}}, status=500)
+            if recorded:
+                time = request.match_info.get("time")
+                path = os.path.join(recorded, "_".join(p for p in request.path.split("/") if p and p != time) + ".json")
+                if os.path.exists(path):
+                    return web.Response(body=replay(path), content_type="application/json")
+            try:
+                time = half_hour(request.match_info.get("time"))
+                args = (int(request.match_info["region"]),) if region else ()
+                if args and args[0] not in REGIONS.values():
+                    raise ValueError
+            except ValueError:
+                return web.json_response({"error": {"code": "400 Bad Request", "message": "Invalid region or time"}}, status=400)
+            return web.Response(body=synthetic(name, time, *args), content_type="application/json")
+        return handler
+
+    app = web.Application()
+    async def root(request):
+        return web.Response(text="Stub Carbon Intensity API")
+
+    app.router.add_get("/", root)
+    app.router.add_get("/intensity", respond("national"))
+    app.router.add_get("/generation", respond("generation"))
+    app.router.add_get("/regional/regionid/{region}", respond("regional", region=True))
+    app.router.add_get("/intensity/{time}/fw48h", respond("national_fw48h"))
+    app.router.add_get("/regional/intensity/{time}/fw48h", respond("regions_fw48h"))
+    app.router.add_get("/regional/intensity/{time}/fw48h/regionid/{region}", respond("regional_fw48h", region=True))
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-p', type=int, default=8001, help="port")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument('--jitter', type=float, default=0.0, help="further seconds of random latency")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests answered with a 500")
+    parser.add_argument('--padding', type=int, default=0, help="extra bytes added to every document")
+    parser.add_argument('--recorded', help="directory of documents recorded from the real API")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(f"Serving stub Carbon Intensity API, set url = http://localhost:{args.p}/ under [CONNECTION] in config.ini")
+    web.run_app(create_stub_app(args.latency, args.jitter, args.error_rate, args.padding, args.recorded, args.seed),
+                port=args.p, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,15 +11,23 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import asyncio
+import json
+import os
+import tempfile
 from unittest import mock, IsolatedAsyncioTestCase
-from carbon_minimiser.carbon_api.carbon_api_wrapper.carbon import CarbonAPI
-from carbon_minimiser.carbon_api.carbon_api_wrapper.api_connection import ApiConnection
+from aiohttp.test_utils import TestServer
+from carbon_minimiser.carbon_api.carbon_api_wrapper.carbon import CarbonAPI, REGIONS
+from carbon_minimiser.carbon_api.carbon_api_wrapper.api_connection import ApiConnection, endpoint_labels
+from carbon_minimiser.carbon_api.carbon_api_wrapper.memo import DocumentMemo
+from carbon_minimiser.carbon_api.stub_server import create_stub_app
 
 
 class TestCarbonAPI(IsolatedAsyncioTestCase):
     @classmethod
     def setUpClass(cls):
-        cls.carbon = CarbonAPI()
+        # documents are mocked per test, so none are kept between calls, see TestDocumentMemo
+        cls.carbon = CarbonAPI(memo_ttl=0)
 
     def setUp(self):
         pass
@@ -102,3 +110,156 @@ class TestCarbonAPI(IsolatedAsyncioTestCase):
                         {'time': '2021-04-27T09:30Z', 'forecast': 223, 'index': 'moderate'},
                         {'time': '2021-04-27T10:00Z', 'forecast': 218, 'index': 'moderate'}]
             self.assertEqual(result, expected)
+
+    async def test_regions_forecast_range(self):
+        data = {'data': [{'from': '2021-04-27T08:30Z', 'regions': [
+                             {'regionid': 1, 'intensity': {'forecast': 10, 'index': 'very low'}},
+                             {'regionid': 13, 'intensity': {'forecast': 233, 'index': 'moderate'}}]},
+                         {'from': '2021-04-27T09:00Z', 'regions': [
+                             {'regionid': 1, 'intensity': {'forecast': 12, 'index': 'very low'}},
+                             {'regionid': 13, 'intensity': {'forecast': 231, 'index': 'moderate'}}]},
+                         {'from': '2021-04-27T09:30Z', 'regions': [
+                             {'regionid': 1, 'intensity': {'forecast': 14, 'index': 'very low'}},
+                             {'regionid': 13, 'intensity': {'forecast': 223, 'index': 'moderate'}}]}]}
+        with mock.patch.object(ApiConnection, "get", return_value=data):
+            result = await self.carbon.regions_forecast_range(["LONDON"], hours=0.5)
+            expected = {'LONDON': [{'time': '2021-04-27T08:30Z', 'forecast': 233, 'index': 'moderate'},
+                                   {'time': '2021-04-27T09:00Z', 'forecast': 231, 'index': 'moderate'}]}
+            self.assertEqual(result, expected)
+            result = await self.carbon.regions_forecast_single(["LONDON", "N_SCOTLAND"], hours=1)
+            self.assertEqual(result, {'LONDON': (223, 'moderate'), 'N_SCOTLAND': (14, 'very low')})
+
+    async def test_snapshot_shares_documents(self):
+        data = {'data': [{'data': [{'intensity': {'forecast': 170, 'index': 'moderate'},
+                                    'generationmix': [{"fuel": "biomass", "perc": 3.6}]}]}]}
+        with mock.patch.object(ApiConnection, "get", return_value=data) as get:
+            async with self.carbon.snapshot():
+                intensity = await self.carbon.current_region_intensity("LONDON")
+                mix = await self.carbon.current_region_mix("LONDON")
+                await self.carbon.current_region_intensity("WALES")
+            self.assertEqual(intensity, (170, 'moderate'))
+            self.assertEqual(mix, {'biomass': 3.6})
+            self.assertEqual(get.call_count, 2)
+            await self.carbon.current_region_intensity("LONDON")
+            self.assertEqual(get.call_count, 3)
+
+
+class TestApiConnection(IsolatedAsyncioTestCase):
+    async def test_session_reused_until_closed(self):
+        connection = ApiConnection("https://example.com/", limit=5, limit_per_host=2)
+        session = connection._session()
+        self.assertIs(connection._session(), session)
+        self.assertEqual(session.connector.limit, 5)
+        self.assertEqual(session.connector.limit_per_host, 2)
+        await connection.close()
+        self.assertTrue(session.closed)
+        self.assertIsNone(connection.session)
+
+
+    def test_endpoint_labels(self):
+        self.assertEqual(endpoint_labels("regional/intensity/2021-04-27T08:30:00.123+00:00/fw48h/regionid/13"),
+                         ("regional/intensity/{from}/fw48h/regionid/{regionid}", "13"))
+        self.assertEqual(endpoint_labels("intensity"), ("intensity", ""))
+
+
+class TestDocumentMemo(IsolatedAsyncioTestCase):
+    async def test_concurrent_requests_share_one_download(self):
+        carbon = CarbonAPI()
+        data = {'data': [{'intensity': {'actual': 170, 'index': 'moderate'}}]}
+
+        async def get(endpoint):
+            await asyncio.sleep(0.01)
+            return data
+
+        with mock.patch.object(ApiConnection, "get", side_effect=get) as get:
+            results = await asyncio.gather(*(carbon.current_national_intensity() for _ in range(10)))
+            self.assertEqual(results, [(170, 'moderate')] * 10)
+            self.assertEqual(get.call_count, 1)
+            await carbon.current_national_intensity()
+            self.assertEqual(get.call_count, 1)
+            # forecasts from a later time in the same half hour are the same document
+            await carbon.national_forecast_range(47.5)
+            await carbon.national_forecast_range(47.5)
+            self.assertEqual(get.call_count, 2)
+
+    async def test_expires_at_half_hour(self):
+        memo = DocumentMemo(ttl=3600)
+        fetch = mock.AsyncMock(return_value={'data': []})
+        with mock.patch("time.time", return_value=1800 * 1000 + 1700):
+            await memo.get("intensity", fetch)
+            await memo.get("intensity", fetch)
+            self.assertEqual(fetch.call_count, 1)
+        with mock.patch("time.time", return_value=1800 * 1001):
+            await memo.get("intensity", fetch)
+            self.assertEqual(fetch.call_count, 2)
+        memo = DocumentMemo(ttl=10)
+        with mock.patch("time.time", return_value=1800 * 1000):
+            await memo.get("intensity", fetch)
+        with mock.patch("time.time", return_value=1800 * 1000 + 10):
+            await memo.get("intensity", fetch)
+        self.assertEqual(fetch.call_count, 4)
+
+    async def test_bounded_and_failures_not_kept(self):
+        memo = DocumentMemo(size=2)
+        fetch = mock.AsyncMock(return_value={'data': []})
+        for endpoint in ("a", "b", "c", "a"):
+            await memo.get(endpoint, fetch)
+        self.assertEqual(fetch.call_count, 4)
+        self.assertEqual(len(memo.entries), 2)
+        fetch = mock.AsyncMock(return_value={'error': {'code': '500'}})
+        await memo.get("d", fetch)
+        await memo.get("d", fetch)
+        self.assertEqual(fetch.call_count, 2)
+        fetch = mock.AsyncMock(side_effect=ConnectionError)
+        results = await asyncio.gather(memo.get("e", fetch), memo.get("e", fetch), return_exceptions=True)
+        self.assertTrue(all(isinstance(r, ConnectionError) for r in results))
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(memo.in_flight, {})
+        await memo.get("e", mock.AsyncMock(return_value={'data': []}))
+        self.assertIn("e", [key for key, _ in memo.entries])
+
+
+class TestStubServer(IsolatedAsyncioTestCase):
+    async def stub(self, **options):
+        server = TestServer(create_stub_app(**options))
+        await server.start_server()
+        self.addAsyncCleanup(server.close)
+        carbon = CarbonAPI(str(server.make_url("/")))
+        self.addAsyncCleanup(carbon.close)
+        return carbon
+
+    async def test_documents(self):
+        carbon = await self.stub()
+        self.assertEqual(await carbon.health_status(), 1)
+        async with carbon.snapshot():
+            regions = await carbon.regions_forecast_range(list(REGIONS), 47.5)
+            london = await carbon.region_forecast_range("LONDON", 47.5)
+            national = await carbon.national_forecast_range(47.5)
+            self.assertEqual(await carbon.regions_forecast_single(["LONDON"], 1), {"LONDON": tuple(london[2].values())[1:]})
+        self.assertEqual(set(regions), set(REGIONS))
+        self.assertTrue(all(len(forecasts) == 96 for forecasts in regions.values()))
+        self.assertEqual(regions["LONDON"], london)
+        self.assertEqual(len(national), 96)
+        self.assertIn(london[0]['time'][-4:], [":00Z", ":30Z"])
+        self.assertEqual(len(await carbon.current_region_intensity("WALES")), 2)
+        self.assertAlmostEqual(sum((await carbon.current_national_mix()).values()), 100, delta=1)
+
+    async def test_errors_and_latency(self):
+        carbon = await self.stub(error_rate=1)
+        self.assertIsNone(await carbon.region_forecast_range("LONDON", 47.5))
+        carbon = await self.stub(latency=0.05)
+        start = asyncio.get_running_loop().time()
+        await carbon.current_national_intensity()
+        self.assertGreaterEqual(asyncio.get_running_loop().time() - start, 0.05)
+
+    async def test_padding_and_recorded_documents(self):
+        carbon = await self.stub(padding=1000)
+        document = await carbon.api.get("intensity")
+        self.assertEqual(len(document["padding"]), 1000)
+        with tempfile.TemporaryDirectory() as recorded:
+            with open(os.path.join(recorded, "regional_intensity_fw48h_regionid_13.json"), "w") as f:
+                json.dump({"data": {"data": [{"from": "2021-04-27T08:30Z", "intensity": {"forecast": 7, "index": "very low"}}]}}, f)
+            carbon = await self.stub(recorded=recorded)
+            self.assertEqual(await carbon.region_forecast_range("LONDON", 47.5),
+                             [{'time': '2021-04-27T08:30Z', 'forecast': 7, 'index': 'very low'}])
+            self.assertEqual(len(await carbon.region_forecast_range("WALES", 47.5)), 96)
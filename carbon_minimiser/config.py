@@ -18,4 +18,29 @@ config = configparser.read("config.ini")
 cache = configparser.getboolean('SETUP', 'cache')
 cache_refresh = configparser.getint('SETUP', 'cache_refresh')
 port = configparser.getint('SETUP', 'port')
+workers = configparser.getint('SETUP', 'workers', fallback=1)
+shared_cache = configparser.getboolean('SETUP', 'shared_cache', fallback=False)
+shared_cache_path = configparser.get('SETUP', 'shared_cache_path', fallback='/tmp/carbon_minimiser.cache')
+shared_cache_size = configparser.getint('SETUP', 'shared_cache_size', fallback=8388608)
+refresh_concurrency = configparser.getint('SETUP', 'refresh_concurrency', fallback=10)
+max_staleness = configparser.getint('SETUP', 'max_staleness', fallback=10800)
+retry_backoff = configparser.getint('SETUP', 'retry_backoff', fallback=30)
+bulk_threshold = configparser.getint('SETUP', 'bulk_threshold', fallback=3)
+materialise = configparser.getboolean('SETUP', 'materialise', fallback=False)
+materialise_budget = configparser.getint('SETUP', 'materialise_budget', fallback=16)
+response_cache_size = configparser.getint('SETUP', 'response_cache_size', fallback=1024)
+snapshot_path = configparser.get('SETUP', 'snapshot_path', fallback='')
+server_timing = configparser.getboolean('SETUP', 'server_timing', fallback=False)
+profile_rate = configparser.getfloat('SETUP', 'profile_rate', fallback=0)
+profile_path = configparser.get('SETUP', 'profile_path', fallback='/tmp/carbon_minimiser.prof')
+profile_dump_every = configparser.getint('SETUP', 'profile_dump_every', fallback=100)
 locations = configparser.get('LOCATIONS',"locations").replace(' ', '').split(',')
+api_url = configparser.get('CONNECTION', 'url', fallback='https://api.carbonintensity.org.uk/')
+connection = {
+    "limit": configparser.getint('CONNECTION', 'limit', fallback=20),
+    "limit_per_host": configparser.getint('CONNECTION', 'limit_per_host', fallback=10),
+    "dns_cache_ttl": configparser.getint('CONNECTION', 'dns_cache_ttl', fallback=300),
+    "keepalive_timeout": configparser.getint('CONNECTION', 'keepalive_timeout', fallback=60),
+    "memo_ttl": configparser.getint('CONNECTION', 'memo_ttl', fallback=300),
+    "memo_size": configparser.getint('CONNECTION', 'memo_size', fallback=256),
+}
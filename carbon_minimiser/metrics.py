@@ -0,0 +1,140 @@
+# Copyright 2022 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Counters, gauges and histograms rendered in the Prometheus text format, kept in memory by each process.
+Recording is a dict lookup and an addition under a lock, cheap enough to leave on in production
+"""
+from bisect import bisect_left
+import threading
+
+# seconds, from a cache hit to a slow upstream request
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, description, labels=(), registry=None):
+        """
+        :param labels: names of the labels every value is recorded with, in order
+        :param registry: registry to render with, REGISTRY by default
+        """
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        (REGISTRY if registry is None else registry).metrics.append(self)
+
+    def samples(self):
+        """
+        :return: list of (name suffix, label names, label values, value)
+        """
+        with self.lock:
+            return [("", self.labels, key, value) for key, value in self.values.items()]
+
+    def render(self):
+        """
+        :return: the metric's lines, empty if nothing has been recorded, so a family recorded by another
+                 process can be added without being repeated
+        """
+        samples = self.samples()
+        if not samples:
+            return ""
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{self.name}{suffix}{_labels(names, values)} {value}" for suffix, names, values, value in samples]
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, description, labels=(), registry=None, function=None):
+        """
+        :param function: called when rendering, returning the value, or a dict of label values to value
+        """
+        super().__init__(name, description, labels, registry)
+        self.function = function
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def samples(self):
+        if self.function is not None:
+            value = self.function()
+            values = value if isinstance(value, dict) else {(): value}
+            return [("", self.labels, key, v) for key, v in values.items() if v is not None]
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), registry=None, buckets=BUCKETS):
+        super().__init__(name, description, labels, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # count in each bucket, then the count above the last bucket, then the sum
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self.lock:
+            values = {key: list(counts) for key, counts in self.values.items()}
+        samples = []
+        names = self.labels + ("le",)
+        for key, counts in values.items():
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                total += count
+                samples.append(("_bucket", names, key + (bound,), total))
+            samples.append(("_sum", self.labels, key, counts[-1]))
+            samples.append(("_count", self.labels, key, total))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def render(self):
+        """
+        :return: every metric in the Prometheus text exposition format
+        """
+        return "".join(metric.render() for metric in self.metrics)
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
@@ -0,0 +1,73 @@
+# Copyright 2022 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from array import array
+from typing import List
+from carbon_minimiser.minimiser_api.matrix import ForecastMatrix
+
+
+class AnswerIndex:
+    """
+    Every window of every length, ranked by average forecast across all locations and within each location,
+    computed once per refresh. A window query then walks its ranking from the top, skipping windows outside
+    the requested range, so the default range is a lookup of the first results
+    """
+    __slots__ = ("locations", "slots", "costs", "tables", "size", "complete")
+
+    def __init__(self, matrix: ForecastMatrix, budget: int):
+        """
+        :param budget: maximum bytes to use, shorter windows are materialised first and the rest left out
+        """
+        self.locations = matrix.locations
+        self.slots = matrix.slots
+        # average of every window of each length, by half_hours then window id, see ForecastMatrix.window_averages
+        self.costs = {}
+        # ranked window ids keyed by (tuple of locations, half_hours)
+        self.tables = {}
+        self.size = 0
+        self.complete = True
+        for half_hours in range(1, matrix.slots + 1):
+            windows = matrix.slots - half_hours + 1
+            costs = array('l', matrix.window_averages(0, matrix.slots, half_hours))
+            rankings = [(tuple(matrix.locations), range(len(costs)))]
+            rankings += [((location,), range(r * windows, (r + 1) * windows)) for r, location in enumerate(matrix.locations)]
+            # the costs, the ranking across all locations, and the per location rankings which together cover each window once
+            size = costs.itemsize * len(costs) * 3
+            if self.size + size > budget:
+                self.complete = False
+                break
+            self.costs[half_hours] = costs
+            for key, ids in rankings:
+                self.tables[(key, half_hours)] = array('l', sorted(ids, key=costs.__getitem__))
+            self.size += size
+
+    def lookup(self, locations: List[str], half_hours: int, start: int, end: int, k: int):
+        """
+        :return: list of (location, start slot, average forecast) of the k best windows of half_hours between
+                 slots start and end, or None if that query was not materialised
+        """
+        ranked = self.tables.get((tuple(locations), half_hours))
+        if ranked is None:
+            return None
+        windows = self.slots - half_hours + 1
+        costs = self.costs[half_hours]
+        results = []
+        if k <= 0:
+            return results
+        for w in ranked:
+            r, s = divmod(w, windows)
+            if start <= s and s + half_hours <= end:
+                results.append((self.locations[r], s, costs[w]))
+                if len(results) == k:
+                    break
+        return results
@@ -11,54 +11,255 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import asyncio
+import time
+from datetime import datetime
+from json import dumps
 from sanic import Sanic
-from sanic.response import json
+from sanic.response import json, raw, empty, text
 from sanic.exceptions import SanicException
 from carbon_minimiser.minimiser_api.minimiser import Minimiser
+from carbon_minimiser.minimiser_api.profiling import RequestProfiler, phase, server_timing, start_timing
+from carbon_minimiser.minimiser_api.responses import ResponseCache, conditional_headers, not_modified
+from carbon_minimiser.minimiser_api.shared_cache import SharedCache, create_shared_file, refresh_shared_cache
+from carbon_minimiser.minimiser_api.subscriptions import Subscriptions
 from carbon_minimiser.carbon_api.carbon_api_wrapper.carbon import REGIONS
+from carbon_minimiser.metrics import CONTENT_TYPE, REGISTRY, Gauge, Histogram, Registry
 import carbon_minimiser.config as CONFIG
 
 LOCATIONS = CONFIG.locations
+# seconds between comments sent to keep an idle event stream open
+KEEPALIVE = 15
+# seconds clients are asked to wait before retrying while no cache snapshot is available
+RETRY_AFTER = 5
+REQUEST_SECONDS = Histogram("carbon_minimiser_request_seconds",
+                            "Time taken to answer requests, until the first byte for streamed responses",
+                            ["route", "method", "status"])
 
 def round_to_half_int(number):
     return round(number * 2) / 2
 
 def get_num_results(request):
-    try:
-        results = int(request.args['results'][0])
-    except KeyError:
-        results = 1
-    except ValueError:
-        raise SanicException("Bad Request, are your arguments formatted correctly?", status_code=400)
+    with phase("parse"):
+        try:
+            results = int(request.args['results'][0])
+            if results < 0:
+                raise ValueError
+        except KeyError:
+            results = 1
+        except ValueError:
+            raise SanicException("Bad Request, are your arguments formatted correctly?", status_code=400)
     return results
 
 
 def get_time_range(request):
+    with phase("parse"):
+        try:
+            range_param = request.args['range'][0].split(",")
+            range = [round_to_half_int(float(r)) for r in range_param]
+            if range[0] > range [1]:
+                raise ValueError
+        except KeyError:
+            range = [0,95]
+        except ValueError:
+            raise SanicException("Bad Request, are your arguments formatted correctly?", status_code=400)
+    return range
+
+def get_profile(request):
     try:
-        range_param = request.args['range'][0].split(",")
-        range = [round_to_half_int(float(r)) for r in range_param]
-        if range[0] > range [1]:
+        profile = [float(p) for p in request.args['profile'][0].split(",")]
+        if any(p < 0 for p in profile):
+            raise ValueError
+    except (KeyError, ValueError):
+        raise SanicException("Bad Request, are your arguments formatted correctly?", status_code=400)
+    return profile
+
+def get_min_run(request):
+    try:
+        min_run = int(request.args['min_run'][0])
+        if min_run < 1:
             raise ValueError
     except KeyError:
-        range = [0,95]
+        min_run = 1
     except ValueError:
         raise SanicException("Bad Request, are your arguments formatted correctly?", status_code=400)
-    return range
+    return min_run
 
 def limit_results(num_results, time_range):
     max_results = int((time_range[1] - time_range[0])*2)
     return num_results if num_results < max_results else max_results
 
 
+def parse_batch_query(query):
+    """
+    :param query: dict of window, and optionally location, results and range as in the window endpoints' URLs
+    :return: keyword arguments for Minimiser.optimal_time_windows, or dict of an error if the query is badly
+             formatted or its location not configured
+    """
+    try:
+        window = float(query['window'])
+        range_param = query.get('range', [0, 95])
+        range_param = range_param.split(",") if isinstance(range_param, str) else range_param
+        time_range = [round_to_half_int(float(r)) for r in range_param]
+        num_results = int(query.get('results', 1))
+        if window < 0.5 or len(time_range) != 2 or time_range[0] > time_range[1] or num_results < 0:
+            raise ValueError
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return {"error": "Bad Request, are your arguments formatted correctly?"}
+    parsed = {"window_len": window, "num_options": limit_results(num_results, time_range), "time_range": time_range}
+    if 'location' not in query:
+        parsed["locations"] = LOCATIONS
+    elif str(query['location']).upper() in LOCATIONS:
+        parsed["location"] = str(query['location']).upper()
+    else:
+        return {"error": "Location not configured"}
+    return parsed
+
+
+def parse_schedule(body):
+    """
+    :param body: dict of jobs, each a dict of window, and optionally deadline and locations, and optionally
+                 capacity, a dict of location to number of jobs it can run at once
+    :return: jobs and capacity for Minimiser.optimal_job_placement
+    """
+    try:
+        jobs = []
+        for job in body['jobs']:
+            window = float(job['window'])
+            deadline = round_to_half_int(float(job.get('deadline', 95)))
+            locations = [str(location).upper() for location in job.get('locations', LOCATIONS)]
+            if window < 0.5 or deadline < 0 or not locations:
+                raise ValueError
+            jobs.append({"window_len": window, "deadline": deadline, "locations": locations})
+        capacity = {str(location).upper(): int(limit) for location, limit in body.get('capacity', {}).items()}
+        if any(limit < 0 for limit in capacity.values()):
+            raise ValueError
+    except (KeyError, TypeError, ValueError, AttributeError):
+        raise SanicException("Bad Request, are your arguments formatted correctly?", status_code=400)
+    if any(location not in LOCATIONS for job in jobs for location in job["locations"]):
+        raise SanicException("Location not configured", status_code=404)
+    return jobs, capacity
+
+
 def create_app():
     app = Sanic("Carbon_Minimiser")
     min = Minimiser()
-    min.set_cache(True, CONFIG.cache_refresh) if CONFIG.cache else min.set_cache(False)
+    if CONFIG.cache and CONFIG.shared_cache:
+        min.set_shared_cache(CONFIG.shared_cache_path)
+        attach_shared_cache(app)
+    else:
+        min.set_cache(True, CONFIG.cache_refresh) if CONFIG.cache else min.set_cache(False)
+        if CONFIG.cache:
+            @app.before_server_start
+            async def start_refresh(app):
+                app.add_task(min.refresh_cache(), name="CacheRefresher")
     attach_endpoints(app, min)
+
+    @app.after_server_stop
+    async def close_connections(app):
+        await min.close()
+
     return app
 
 
+def attach_shared_cache(app):
+    """
+    Runs a single cache refresher process alongside the workers, which all read its snapshots
+    """
+    @app.main_process_start
+    async def create_shared_cache(app):
+        create_shared_file(CONFIG.shared_cache_path, CONFIG.shared_cache_size)
+
+    @app.main_process_ready
+    async def start_refresher(app):
+        app.manager.manage("CacheRefresher", refresh_shared_cache,
+                           {"refresh_rate": CONFIG.cache_refresh, "path": CONFIG.shared_cache_path})
+
+
 def attach_endpoints(app, min):
+    responses = ResponseCache(CONFIG.response_cache_size)
+    subscriptions = Subscriptions(min)
+
+    def snapshot_age():
+        created = min.cache.get("created") if min.cache and min.cache_generation() else None
+        return round(time.time() - datetime.fromisoformat(created).timestamp(), 3) if created else None
+
+    def refresher_metrics():
+        """
+        :return: metrics of the refresher process, published alongside the snapshot when the cache is shared
+        """
+        return min.cache.cache.get("metrics", "") if isinstance(min.cache, SharedCache) else ""
+
+    gauges = Registry()
+    Gauge("carbon_minimiser_snapshot_age_seconds", "Time since the cache snapshot being served was created",
+          registry=gauges, function=snapshot_age)
+    Gauge("carbon_minimiser_snapshot_generation", "Cache snapshots published since starting",
+          registry=gauges, function=min.cache_generation)
+
+    profiler = RequestProfiler(CONFIG.profile_rate, CONFIG.profile_path, CONFIG.profile_dump_every) \
+        if CONFIG.profile_rate > 0 else None
+
+    @app.on_request
+    async def start_timer(request):
+        request.ctx.start = time.perf_counter()
+        if CONFIG.server_timing:
+            start_timing()
+        request.ctx.profile = profiler.start() if profiler else None
+
+    @app.on_request
+    async def readiness_gate(request):
+        # without a snapshot every query would fail, so clients are told to come back rather than sent an error
+        if request.path.startswith("/optimise") and not min.ready():
+            return json("Cache not ready", 503, headers={"Retry-After": str(RETRY_AFTER)})
+
+    @app.on_response
+    async def record_latency(request, response):
+        if hasattr(request.ctx, "start"):
+            elapsed = time.perf_counter() - request.ctx.start
+            route = f"/{request.route.path}" if request.route else "unmatched"
+            REQUEST_SECONDS.observe(elapsed, route, request.method, response.status)
+            if request.ctx.profile is not None:
+                profiler.stop(request.ctx.profile)
+            timing = server_timing(elapsed)
+            if timing is not None:
+                response.headers["Server-Timing"] = timing
+
+    @app.after_server_stop
+    async def save_profile(app):
+        if profiler:
+            profiler.dump()
+
+    @app.before_server_start
+    async def follow_subscriptions(app):
+        subscriptions.follow()
+
+    @app.after_server_stop
+    async def close_subscriptions(app):
+        subscriptions.close()
+
+    async def cached_json(request, key, compute):
+        """
+        Identical queries give identical bodies until the next cache refresh, so the serialised body is reused,
+        and clients and proxies are told they can keep it until then
+        """
+        generation = min.cache_generation()
+        if generation is None:
+            result = await compute()
+            with phase("serialise"):
+                return json(result)
+        headers = conditional_headers(key, generation, await min.cache_timestamp(), CONFIG.cache_refresh)
+        if not_modified(request.headers, headers):
+            return empty(304, headers=headers)
+        with phase("response_cache"):
+            body = responses.get(generation, key)
+        if body is None:
+            result = await compute()
+            with phase("serialise"):
+                body = json(result).body
+            responses.put(generation, key, body)
+        return raw(body, content_type="application/json", headers=headers)
+
+
     @app.get('/')
     async def root(request):
         return json("Carbon Minimiser")
@@ -73,18 +274,38 @@ def attach_endpoints(app, min):
         return json(result)
 
 
+    @app.get('/ready')
+    async def ready(request):
+        if min.ready():
+            return json("Ready")
+        return json("Cache not ready", 503, headers={"Retry-After": str(RETRY_AFTER)})
+
+
+    @app.get('/metrics')
+    async def metrics(request):
+        return text(REGISTRY.render() + gauges.render() + refresher_metrics(), content_type=CONTENT_TYPE)
+
+
+    @app.get('/freshness')
+    async def freshness(request):
+        try:
+            result = await min.forecast_age(LOCATIONS)
+        except KeyError:
+            result = "Cache not found"
+        return json(result)
+
+
     @app.get('/optimise')
     async def optimal_time_and_location(request):
         time_range = get_time_range(request)
         num_results = limit_results(get_num_results(request), time_range)
-        result = await min.optimal_time_and_location(LOCATIONS, num_options=num_results, time_range=time_range)
-        return json(result)
+        return await cached_json(request, ("optimise", num_results, tuple(time_range)),
+                                 lambda: min.optimal_time_and_location(LOCATIONS, num_options=num_results, time_range=time_range))
 
 
     @app.get('/optimise/location')
     async def optimal_location(request):
-        result = await min.optimal_location_now(LOCATIONS)
-        return json(result)
+        return await cached_json(request, ("optimise/location",), lambda: min.optimal_location_now(LOCATIONS))
 
 
     @app.get('/optimise/location/<location>')
@@ -93,8 +314,8 @@ def attach_endpoints(app, min):
         time_range = get_time_range(request)
         num_results = limit_results(get_num_results(request), time_range)
         if location in LOCATIONS:
-            result = await min.optimal_time_for_location(location, num_options=num_results, time_range=time_range)
-            return json(result)
+            return await cached_json(request, ("optimise/location/<location>", location, num_results, tuple(time_range)),
+                                     lambda: min.optimal_time_for_location(location, num_options=num_results, time_range=time_range))
         else:
             return json("Location not configured", 404)
 
@@ -105,11 +326,11 @@ def attach_endpoints(app, min):
         time_range = get_time_range(request)
         num_results = limit_results(get_num_results(request), time_range)
         if location in LOCATIONS:
-            result = await min.optimal_time_window_for_location(location, 
-                                                                window, 
-                                                                num_options=num_results,
-                                                                time_range=time_range)
-            return json(result)
+            return await cached_json(request, ("optimise/location/<location>/window", location, window, num_results, tuple(time_range)),
+                                     lambda: min.optimal_time_window_for_location(location, 
+                                                                                  window, 
+                                                                                  num_options=num_results,
+                                                                                  time_range=time_range))
         else:
             return json("Location not configured", 404)
 
@@ -118,5 +339,92 @@ def attach_endpoints(app, min):
     async def optimal_time_window_and_location(request, window):
         time_range = get_time_range(request)
         num_results = limit_results(get_num_results(request), time_range)
-        result = await min.optimal_time_window_and_location(LOCATIONS, window, num_options=num_results, time_range=time_range)
-        return json(result)
+        return await cached_json(request, ("optimise/location/window", window, num_results, tuple(time_range)),
+                                 lambda: min.optimal_time_window_and_location(LOCATIONS, window, num_options=num_results, time_range=time_range))
+
+
+    @app.get('/optimise/location/<location>/slots/<slots:int>')
+    async def optimal_times_for_location(request, location, slots):
+        location = location.upper()
+        min_run = get_min_run(request)
+        time_range = get_time_range(request)
+        if slots < 1:
+            raise SanicException("Bad Request, are your arguments formatted correctly?", status_code=400)
+        if location in LOCATIONS:
+            return await cached_json(request, ("optimise/location/<location>/slots", location, slots, min_run, tuple(time_range)),
+                                     lambda: min.optimal_times_for_location(location, slots, min_run=min_run, time_range=time_range))
+        else:
+            return json("Location not configured", 404)
+
+
+    @app.get('/optimise/location/<location>/profile')
+    async def optimal_profile_time_for_location(request, location):
+        location = location.upper()
+        profile = get_profile(request)
+        time_range = get_time_range(request)
+        num_results = limit_results(get_num_results(request), time_range)
+        if location in LOCATIONS:
+            return await cached_json(request, ("optimise/location/<location>/profile", location, tuple(profile), num_results, tuple(time_range)),
+                                     lambda: min.optimal_profile_time_for_location(location,
+                                                                                   profile,
+                                                                                   num_options=num_results,
+                                                                                   time_range=time_range))
+        else:
+            return json("Location not configured", 404)
+
+
+    @app.get('/optimise/location/profile')
+    async def optimal_profile_time_and_location(request):
+        profile = get_profile(request)
+        time_range = get_time_range(request)
+        num_results = limit_results(get_num_results(request), time_range)
+        return await cached_json(request, ("optimise/location/profile", tuple(profile), num_results, tuple(time_range)),
+                                 lambda: min.optimal_profile_time_and_location(LOCATIONS, profile, num_options=num_results, time_range=time_range))
+
+
+    @app.post('/optimise/batch')
+    async def optimal_time_windows(request):
+        queries = request.json
+        if not isinstance(queries, list):
+            raise SanicException("Bad Request, expected a list of queries", status_code=400)
+        parsed = [parse_batch_query(query) for query in queries]
+        results = min.optimal_time_windows([query for query in parsed if "error" not in query])
+        response = await request.respond(content_type="application/x-ndjson")
+        # one line per query, in the order given, as each is ranked
+        for query in parsed:
+            line = query if "error" in query else {"result": await anext(results)}
+            await response.send(dumps(line) + "\n")
+        await response.eof()
+
+
+    @app.post('/optimise/schedule')
+    async def optimal_job_placement(request):
+        jobs, capacity = parse_schedule(request.json)
+        return json(await min.optimal_job_placement(jobs, capacity))
+
+
+    @app.post('/optimise/subscribe')
+    async def subscribe(request):
+        if not min.cache:
+            return json("Subscriptions need the cache enabled", 404)
+        queries = request.json
+        if not isinstance(queries, list):
+            raise SanicException("Bad Request, expected a list of queries", status_code=400)
+        parsed = [parse_batch_query(query) for query in queries]
+        errors = [query["error"] for query in parsed if "error" in query]
+        if errors:
+            raise SanicException(errors[0], status_code=400)
+        subscription = await subscriptions.add(parsed)
+        response = await request.respond(content_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+        try:
+            # every result to begin with, and then each one that changes after a refresh
+            while True:
+                try:
+                    changes = await asyncio.wait_for(subscription.changes.get(), KEEPALIVE)
+                except asyncio.TimeoutError:
+                    await response.send(": keepalive\n\n")
+                    continue
+                for i, result in changes:
+                    await response.send(f"data: {dumps({'query': i, 'result': result})}\n\n")
+        finally:
+            subscriptions.remove(subscription)
@@ -12,57 +12,272 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import asyncio
+import random
+import time
 from carbon_minimiser.carbon_api.carbon_api_wrapper.carbon import CarbonAPI
+from carbon_minimiser.minimiser_api.answers import AnswerIndex
+from carbon_minimiser.minimiser_api.matrix import ForecastMatrix
+from carbon_minimiser.minimiser_api.snapshots import load_snapshot, save_snapshot
+from carbon_minimiser.metrics import Counter, Histogram
 from datetime import datetime
+from types import MappingProxyType
 import carbon_minimiser.config as CONFIG
 
 LOCATIONS = CONFIG.locations
+# entries computed from the rest of a snapshot, rather than requested from the API
+DERIVED = ["forecast_matrix", "answer_index"]
+REFRESH_SECONDS = Histogram("carbon_minimiser_refresh_seconds", "Time taken to refresh the cache",
+                            buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+REFRESHES = Counter("carbon_minimiser_refreshes_total",
+                    "Cache refreshes, complete, partial where some entries kept their last good value, or failed",
+                    ["outcome"])
+FAILED_ENTRIES = Counter("carbon_minimiser_refresh_failed_entries_total", "Cache entries that failed to refresh")
+
+
+def derive(cache):
+    """
+    Adds the structures queries are answered from to a snapshot, so they are built once per refresh
+    """
+    forecasts = cache["region_forecast_range"]
+    current = cache["current_region_intensity"]
+    # leave out locations whose forecast could not be collected
+    locations = [location for location in LOCATIONS if forecasts.get(f"('{location}', 47.5)")]
+    cache["forecast_matrix"] = ForecastMatrix.from_forecasts(locations,
+                                                             [forecasts[f"('{location}', 47.5)"] for location in locations],
+                                                             [current.get(location) for location in locations])
+    cache["answer_index"] = None
+    if CONFIG.materialise:
+        answers = AnswerIndex(cache["forecast_matrix"], CONFIG.materialise_budget * 1024 * 1024)
+        print(f"Materialised {len(answers.tables)} answer tables in {answers.size / 1024 / 1024:.1f}MB"
+              f"{'' if answers.complete else ', longer windows left out to stay within materialise_budget'}")
+        cache["answer_index"] = answers
+    return cache
+
+
+def freeze(value):
+    """
+    Published snapshots are read by queries without copying, so they are made read only, dicts as mapping proxies
+    and lists as tuples. Derived entries are left as they are, nothing writes to them once built
+    """
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def thaw(value):
+    """
+    :return: plain dicts and lists copy of a frozen snapshot entry, see freeze
+    """
+    if isinstance(value, MappingProxyType):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(v) for v in value]
+    return value
+
+
+def without_derived(cache):
+    """
+    :return: the entries of a snapshot that were requested from the API, for storing or sharing
+    """
+    return {k: thaw(v) for k, v in cache.items() if k not in DERIVED}
+
 
 class Cache:
-    def __init__(self, refresh_rate):
+    def __init__(self, refresh_rate, concurrency=CONFIG.refresh_concurrency, bulk_threshold=CONFIG.bulk_threshold,
+                 max_staleness=CONFIG.max_staleness, retry_backoff=CONFIG.retry_backoff):
         self.refresh_rate = refresh_rate
-        self.carbonAPI = CarbonAPI()
-        self.cache = {}
+        self.max_staleness = max_staleness
+        self.retry_backoff = retry_backoff
+        self.concurrency = concurrency
+        self.bulk_threshold = bulk_threshold
+        self.refresh_duration = None
+        self.carbonAPI = CarbonAPI(CONFIG.api_url, **CONFIG.connection)
+        # the published snapshot, replaced whole by each refresh and never modified
+        self.cache = freeze({})
+        self.generation = 0
+        self.listeners = []  # called with each new snapshot once published
+        self.loop = None
+        self.task = None
         self.HOURS_PARAM = 47.5  # Get max forecast
         self.gather_functions()
 
     def start_caching(self):
-        asyncio.run(self.periodic_task(self.refresh_rate, self.create_cache))
+        """
+        Refreshes the cache on a loop of its own, blocking until stopped, see shared_cache.refresh_shared_cache
+        """
+        asyncio.run(self.run())
+
+    async def run(self):
+        """
+        Refreshes the cache on the running loop until stopped, so snapshots are published on the loop that reads them
+        """
+        try:
+            await self.periodic_task(self.refresh_rate, self.create_cache)
+        except asyncio.CancelledError:
+            pass
+
+    def stop_caching(self):
+        """
+        Cancels the refresh loop, from any thread, closing its connections to the API
+        """
+        if self.task is not None:
+            self.loop.call_soon_threadsafe(self.task.cancel)
     
+    def restore(self, path):
+        """
+        Publishes the snapshot saved at path, if it is still within the forecast horizon, so it can be served
+        straight away rather than waiting for the first refresh
+        """
+        cache = load_snapshot(path, self.HOURS_PARAM * 60 * 60)
+        if cache is not None:
+            print(f"Restored cache created {cache['created']}")
+            self.publish(derive(cache))
+
+    def persist(self, path):
+        """
+        Saves every snapshot published from now on to path, see restore
+        """
+        self.listeners.append(lambda cache: save_snapshot(path, without_derived(cache)))
+
     async def periodic_task(self, refresh_rate, task):
-        await task()  # initial run of task
-        while True:
-            await asyncio.sleep(refresh_rate)
-            await task()  # repeated run of task
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        try:
+            if self.cache:
+                # a restored snapshot is served until it is due a refresh
+                age = (datetime.now() - datetime.fromisoformat(self.cache['created'])).total_seconds()
+                await asyncio.sleep(max(refresh_rate - age, 0))
+            failed = await task()  # initial run of task
+            attempt = 0
+            while True:
+                if failed:
+                    # retry sooner than the next refresh, with jitter so workers don't retry in step
+                    attempt += 1
+                    delay = min(self.retry_backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5), refresh_rate)
+                    print(f"{failed} cache entries failed, retrying in {delay:.0f}s")
+                else:
+                    attempt = 0
+                    delay = refresh_rate
+                await asyncio.sleep(delay)
+                failed = await task()  # repeated run of task
+        finally:
+            await self.carbonAPI.close()
 
     async def create_cache(self):
-        cache = {"created": datetime.now().isoformat()}
+        """
+        Requests every cached function concurrently, at most self.concurrency at a time,
+        and only replaces the cache once all results have been collected.
+        An entry that fails keeps its last good value until it is older than self.max_staleness
+        :return: number of entries that failed
+        """
+        start = time.perf_counter()
+        now = time.time()
+        cache = {"created": datetime.now().isoformat(), "updated": {}}
+        semaphore = asyncio.Semaphore(self.concurrency)
+        calls = []
         for functions in self.functions:
             func = functions['func']
-            cache[func.__name__] = {}
+            name = functions.get('name', func.__name__)
             params = functions['params']
-            print(f"Caching function {func.__name__}")
-            if isinstance(params, list):
+            if functions.get('bulk'):
+                # one request answers for every region, stored under each region's usual key
+                regions, hours = params
+                cache[name] = {}
+                cache["updated"][name] = {}
+                calls.append((name, [(region, str((region, hours))) for region in regions], func, params))
+            elif isinstance(params, list):
+                cache[name] = {}
+                cache["updated"][name] = {}
                 for param in params:
-                    print(f"\t with params: {param}")
-                    if isinstance(param, tuple):
-                        result = await func(*param)
-                    else:
-                        result = await func(param)
-                    cache[func.__name__][str(param)] = result
-            elif len(params):
-                print(f"\t with param: {param}")
-                result = await func(*param if isinstance(param, tuple) else param)
-                cache[func.__name__][params] = result
+                    calls.append((name, str(param), func, param if isinstance(param, tuple) else (param,)))
+            else:
+                calls.append((name, None, func, ()))
+        # accessors sharing an API document, e.g. regional intensity and mix, share one download
+        async with self.carbonAPI.snapshot():
+            results = await asyncio.gather(*[self._call(semaphore, func, args) for _, _, func, args in calls])
+        entries = []
+        for (name, key, _, _), result in zip(calls, results):
+            if isinstance(key, list):
+                entries += [(name, region_key, result.get(region) if result else None) for region, region_key in key]
+            else:
+                entries.append((name, key, result))
+        failed = sum(result is None for _, _, result in entries)
+        FAILED_ENTRIES.inc(amount=failed)
+        if failed == len(entries):
+            print("Cache refresh failed, keeping the current cache")
+            REFRESHES.inc("failed")
+            return failed
+        for name, key, result in entries:
+            updated = now
+            if result is None:
+                result, updated = self._last_good(name, key, now)
+            if key is None:
+                cache[name] = result
+                cache["updated"][name] = updated
             else:
-                result = await func()
-                cache[func.__name__] = result
+                cache[name][key] = result
+                cache["updated"][name][key] = updated
+        cache = derive(cache)
+        self.refresh_duration = time.perf_counter() - start
+        REFRESH_SECONDS.observe(self.refresh_duration)
+        REFRESHES.inc("partial" if failed else "complete")
+        self.publish(cache)
+        print(f"Cache Created! Refresh took {self.refresh_duration:.2f}s for {len(calls)} requests")
+        return failed
+
+    def _last_good(self, name, key, now):
+        """
+        :return: the current value of an entry and when it was collected, or (None, None) if that is
+                 longer ago than self.max_staleness
+        """
+        value = self.cache.get(name)
+        updated = self.cache.get("updated", {}).get(name)
+        if key is not None:
+            value = value.get(key) if value else None
+            updated = updated.get(key) if updated else None
+        if value is None or updated is None or now - updated > self.max_staleness:
+            return None, None
+        return value, updated
+
+    def publish(self, cache):
+        """
+        Replaces the cache with a complete snapshot, frozen so it is never changed once published,
+        and passes it to each listener
+        """
+        cache = freeze(cache)
         self.cache = cache
-        print("Cache Created!")
+        self.generation += 1
+        for listener in self.listeners:
+            try:
+                listener(cache)
+            except Exception as e:
+                print(f"Failed to publish cache to {listener}")
+                print(e)
+
+    @staticmethod
+    async def _call(semaphore, func, args):
+        async with semaphore:
+            try:
+                return await func(*args)
+            except Exception as e:
+                print(f"Failed to collect {func.__name__}{args}")
+                print(repr(e))
+                return None
     
     def get(self, attr):
         return self.cache[attr]
 
+    def get_generation(self):
+        return self.generation
+
+    def ready(self):
+        """
+        :return: whether a snapshot has been published, restored or refreshed
+        """
+        return self.generation > 0
+
     def gather_functions(self):
         functions_no_params = ["current_national_intensity", "current_national_mix"]
         functions_region_param = ["current_region_intensity", "current_region_mix"]
@@ -75,5 +290,11 @@ class Cache:
             self.functions.append({"func": getattr(self.carbonAPI, func_name), "params": [region for region in LOCATIONS]})
         for func_name in functions_hours_param:
             self.functions.append({"func": getattr(self.carbonAPI, func_name), "params": [self.HOURS_PARAM]})
-        for func_name in functions_region_and_hours_params:
-            self.functions.append({"func": getattr(self.carbonAPI, func_name), "params": [(region, self.HOURS_PARAM) for region in LOCATIONS]})
+        if len(LOCATIONS) > self.bulk_threshold:
+            # the all regions forecast is one request, rather than one per location
+            for func_name in functions_region_and_hours_params:
+                bulk_func = getattr(self.carbonAPI, func_name.replace("region_", "regions_"))
+                self.functions.append({"func": bulk_func, "params": (LOCATIONS, self.HOURS_PARAM), "name": func_name, "bulk": True})
+        else:
+            for func_name in functions_region_and_hours_params:
+                self.functions.append({"func": getattr(self.carbonAPI, func_name), "params": [(region, self.HOURS_PARAM) for region in LOCATIONS]})
@@ -0,0 +1,169 @@
+# Copyright 2022 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from array import array
+from heapq import merge
+from itertools import accumulate, islice
+from operator import mul
+from typing import List
+
+
+def time_slots(time_range, length: int):
+    """
+    :param time_range: list defining start and end time range in hours from current time
+    :param length: number of half hourly forecasts available
+    :return: start and end slot of the forecasts within the time range
+    """
+    start, end, _ = slice(int(time_range[0]*2), int(time_range[1])*2).indices(length)
+    return start, end
+
+
+class ForecastMatrix:
+    """
+    Forecasts for a list of locations held as one contiguous locations x slots array, row major, with a single
+    time axis shared by every location. Cell (r, t) is at r * slots + t, so sorting cells by their flat index
+    orders them by location and then time, matching a stable sort over the concatenated forecasts
+    """
+    __slots__ = ("locations", "rows", "slots", "times", "forecasts", "indexes", "prefix", "order", "current")
+
+    def __init__(self, locations: List[str], slots: int, times: List[str], forecasts: array, indexes: List[str],
+                 current: List[tuple] = None):
+        """
+        :param current: each location's (intensity, index) right now, see CarbonAPI.current_region_intensity
+        """
+        self.locations = locations
+        self.rows = {location: r for r, location in enumerate(locations)}
+        self.slots = slots
+        self.times = times
+        self.forecasts = forecasts
+        self.indexes = indexes
+        self.current = current
+        # cumulative totals of each row, with a stride of slots + 1 as each row starts from 0
+        self.prefix = array('q')
+        # cells of each row sorted by forecast, ties in time order
+        self.order = array('l')
+        for r in range(len(locations)):
+            self.prefix.extend(accumulate(forecasts[r * slots:(r + 1) * slots], initial=0))
+            self.order.extend(sorted(range(r * slots, (r + 1) * slots), key=forecasts.__getitem__))
+
+    @classmethod
+    def from_forecasts(cls, locations: List[str], forecasts: List[List[dict]], current: List[tuple] = None):
+        """
+        :param forecasts: each location's half hourly forecasts, as returned by CarbonAPI.region_forecast_range
+        """
+        # rows carried over from an earlier refresh start earlier, so every row is aligned to the latest start
+        latest = max((times[0]['time'] for times in forecasts if times), default=None)
+        forecasts = [times[next((i for i, f in enumerate(times) if f['time'] == latest), 0):] for times in forecasts]
+        slots = min((len(times) for times in forecasts), default=0)
+        times = [f['time'] for f in forecasts[0][:slots]] if forecasts else []
+        return cls(list(locations), slots, times,
+                   array('l', [f['forecast'] for location_times in forecasts for f in location_times[:slots]]),
+                   [f['index'] for location_times in forecasts for f in location_times[:slots]],
+                   current)
+
+    def select(self, locations: List[str]):
+        """
+        :return: matrix of just the given locations, in that order. Raises KeyError for an unknown location
+        """
+        if locations == self.locations:
+            return self
+        cells = [c for location in locations
+                 for c in range(self.rows[location] * self.slots, (self.rows[location] + 1) * self.slots)]
+        current = [self.current[self.rows[location]] for location in locations] if self.current else None
+        return ForecastMatrix(list(locations), self.slots, self.times,
+                              array('l', [self.forecasts[c] for c in cells]), [self.indexes[c] for c in cells], current)
+
+    def smallest_cells(self, start: int, end: int, k: int) -> List[int]:
+        """
+        k way merge of each row's pre-sorted cells, so only the cells ahead of the k smallest are visited.
+        Ties resolve by location and then time, the same as a stable sort over all cells
+        :return: flat index of the k cells with lowest forecast between slots start and end
+        """
+        rows = [filter(lambda c, base=r * self.slots: start <= c - base < end, self.order[r * self.slots:(r + 1) * self.slots])
+                for r in range(len(self.locations))]
+        return list(islice(merge(*rows, key=self.forecasts.__getitem__), k))
+
+    def cheapest_cells(self, row: int, start: int, end: int, count: int, min_run: int = 1) -> List[int]:
+        """
+        Selection of the count lowest forecast cells of a row between slots start and end, taken as runs of at least
+        min_run consecutive cells. Without a minimum run this is smallest_cells on that row, otherwise a dynamic
+        programme over each slot, the number of cells taken so far and the length of the current run, capped at min_run
+        :return: flat index of the chosen cells in time order, None if count cells cannot be taken
+        """
+        if count > max(end - start, 0):
+            return None
+        if min_run <= 1:
+            cells = filter(lambda c: start <= c - row * self.slots < end, self.order[row * self.slots:(row + 1) * self.slots])
+            return sorted(islice(cells, count))
+        states = min_run + 1
+        # lowest total of taking k cells so far and being j cells into a run, or out of one if 0, at best[k * states + j]
+        best = [0] + [float('inf')] * ((count + 1) * states - 1)
+        # state each entry of best came from, for every slot
+        came_from = []
+        for t in range(start, end):
+            forecast = self.forecasts[row * self.slots + t]
+            step = [float('inf')] * len(best)
+            previous = array('b', [0]) * len(best)
+            for k in range(count + 1):
+                i = k * states
+                # leaving out this cell ends any run, if it is long enough
+                step[i], previous[i] = min((best[i], 0), (best[i + min_run], min_run))
+                if k:
+                    taken = i - states
+                    for j in range(1, min_run):
+                        step[i + j], previous[i + j] = best[taken + j - 1] + forecast, j - 1
+                    total, previous[i + min_run] = min((best[taken + min_run - 1], min_run - 1), (best[taken + min_run], min_run))
+                    step[i + min_run] = total + forecast
+            came_from.append(previous)
+            best = step
+        total, state = min((best[count * states], 0), (best[count * states + min_run], min_run))
+        if total == float('inf'):
+            return None
+        cells = []
+        k = count
+        for t in range(end - 1, start - 1, -1):
+            previous = came_from[t - start][k * states + state]
+            if state:
+                cells.append(row * self.slots + t)
+                k -= 1
+            state = previous
+        return cells[::-1]
+
+    def window_averages(self, start: int, end: int, half_hours: int) -> List[int]:
+        """
+        Window w of row r starts at slot start + w - r * (end - start - half_hours + 1)
+        :return: rounded average forecast of every window of half_hours between slots start and end, row by row
+        """
+        stride = self.slots + 1
+        return [round((self.prefix[r * stride + s + half_hours] - self.prefix[r * stride + s]) / half_hours)
+                for r in range(len(self.locations)) for s in range(start, end - half_hours + 1)]
+
+    def window_emissions(self, start: int, end: int, profile: List[float]) -> List[float]:
+        """
+        Convolution of each row with the profile, one dot product per window
+        Window w of row r starts at slot start + w - r * (end - start - len(profile) + 1)
+        :param profile: energy used in each half hour of the window, in kWh
+        :return: total emissions in gCO2 of every window following profile between slots start and end, row by row
+        """
+        length = len(profile)
+        return [sum(map(mul, self.forecasts[r * self.slots + s:r * self.slots + s + length], profile))
+                for r in range(len(self.locations)) for s in range(start, end - length + 1)]
+
+    def cell(self, c: int, location: bool = False) -> dict:
+        """
+        :return: dict of the time, forecast and index of flat cell c, optionally with its location
+        """
+        result = {"time": self.times[c % self.slots], "forecast": self.forecasts[c], "index": self.indexes[c]}
+        if location:
+            result["location"] = self.locations[c // self.slots]
+        return result
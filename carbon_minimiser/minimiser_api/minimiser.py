@@ -13,53 +13,111 @@
 # limitations under the License.
 from carbon_minimiser.carbon_api.carbon_api_wrapper.carbon import CarbonAPI
 from carbon_minimiser.minimiser_api.cache import Cache
-from itertools import islice
-from typing import List
-import threading
+from carbon_minimiser.minimiser_api.shared_cache import SharedCache
+from carbon_minimiser.minimiser_api.matrix import ForecastMatrix, time_slots
+from carbon_minimiser.minimiser_api.placement import place_jobs
+from carbon_minimiser.minimiser_api.profiling import phase
+from carbon_minimiser.metrics import Counter
+from heapq import nsmallest
+from typing import Dict, List
+import time
+import carbon_minimiser.config as CONFIG
+
+CANDIDATES = Counter("carbon_minimiser_candidates_evaluated_total",
+                     "Half hours or windows ranked to answer queries, not counting materialised answers", ["query"])
+
 
 class Minimiser:
     def __init__(self):
-        self.api = CarbonAPI()
+        self.api = CarbonAPI(CONFIG.api_url, **CONFIG.connection)
 
     def set_cache(self, cache, refresh_rate=None):
+        """
+        The cache is refreshed by refresh_cache, once the loop requests are served on is running
+        """
         self.cache = Cache(refresh_rate) if cache else False
-        if cache:
-            thread = threading.Thread(target=self.cache.start_caching, daemon=True)
-            thread.start()
-
-    @staticmethod
-    def _window(seq: List, n: int):
-        """
-        :return: Returns a sliding window (of width n) over data from the iterable
-        s -> (s0,s1,...s[n-1]), (s1,s2,...,sn), ...
-        from: https://stackoverflow.com/questions/6822725/rolling-or-sliding-window-iterator
-        """
-        it = iter(seq)
-        result = tuple(islice(it, n))
-        if len(result) == n:
-            yield result
-        for elem in it:
-            result = result[1:] + (elem,)
-            yield result
-    
+        if cache and CONFIG.snapshot_path:
+            self.cache.restore(CONFIG.snapshot_path)
+            self.cache.persist(CONFIG.snapshot_path)
+
+    async def refresh_cache(self):
+        """
+        Keeps the cache up to date until closed, run as a task alongside the requests reading it
+        """
+        await self.cache.run()
+
+    def set_shared_cache(self, path):
+        """
+        Reads the cache published by a separate refresher process, see shared_cache.refresh_shared_cache
+        """
+        self.cache = SharedCache(path)
+
+    async def close(self):
+        """
+        Closes connections to the Carbon Intensity API, stopping the cache refresh if running
+        """
+        await self.api.close()
+        if self.cache:
+            self.cache.stop_caching()
+
+    async def _matrix(self, locations: List[str], hours: float) -> ForecastMatrix:
+        """
+        :return: forecasts for the given locations, from the cache or requested from the API
+        """
+        if self.cache:
+            matrix = self.cache.get("forecast_matrix")
+            # locations whose forecast is unavailable, or too stale to serve, are left out
+            return matrix.select([location for location in locations if location in matrix.rows])
+        forecasts = [await self.api.region_forecast_range(location, hours) for location in locations]
+        return ForecastMatrix.from_forecasts(locations, forecasts)
+
+    def ready(self):
+        """
+        :return: whether queries can be answered, False until the first cache snapshot is available
+        """
+        return not self.cache or self.cache.ready()
+
+    def cache_generation(self):
+        """
+        :return: generation of the current cache snapshot, increasing with each refresh. None if not caching
+        """
+        return self.cache.get_generation() if self.cache else None
+
     async def cache_timestamp(self):
         return self.cache.get('created')
 
+    async def forecast_age(self, locations: List[str]):
+        """
+        Given a list of locations, returns how long ago each location's forecast was collected
+        :param locations: list of locations, see carbon_api_wrapper.carbon.REGIONS
+        :return: dict of location to age in seconds, None if no forecast is being served for it
+        """
+        if not self.cache:
+            # forecasts are requested as they are needed
+            return {location: 0 for location in locations}
+        updated = self.cache.get("updated")["region_forecast_range"]
+        now = time.time()
+        ages = {}
+        for location in locations:
+            collected = updated.get(f"('{location}', 47.5)")
+            ages[location] = round(now - collected) if collected is not None else None
+        return ages
+
     async def optimal_location_now(self, locations: List[str]):
         """
         Given a list of locations, returns the location with lowest carbon intensity right now
         :param locations: list of locations, see carbon_api_wrapper.carbon.REGIONS
         :return: dict of optimal location, carbon cost, and carbon index
         """
-        options = []
-        for location in locations:
-            if self.cache:
-                intensity, index = self.cache.get("current_region_intensity")[location]
-            else:
-                intensity, index = await self.api.current_region_intensity(location)
-            options.append({"location": location, "forecast": intensity, "index": index})
-        sorted_locations = sorted(options, key=lambda x: x['forecast'])
-        return sorted_locations[0]
+        if self.cache:
+            matrix = await self._matrix(locations, 48)
+            locations, current = matrix.locations, matrix.current
+        else:
+            current = [await self.api.current_region_intensity(location) for location in locations]
+        available = [r for r in range(len(current)) if current[r] is not None]
+        optimal = min(available, key=lambda r: current[r][0])
+        intensity, index = current[optimal]
+        return {"location": locations[optimal], "forecast": intensity, "index": index}
 
     async def optimal_time_for_location(self, location: str, num_options: int = 1, time_range=[0, 47.5]):
         """
@@ -68,14 +126,15 @@ class Minimiser:
         :param num_options: define the number of top options returned
         :return: dict containing optimal time, carbon forecast, carbon index, and location. List of dicts if num_options > 1
         """
-        if self.cache:
-            times = self.cache.get("region_forecast_range")[f"('{location}', 47.5)"]
-        else:
-            times = await self.api.region_forecast_range(location, time_range[1])
-        # cut off times outside of time range
-        times = times[int(time_range[0]*2):int(time_range[1])*2]
-        sorted_times = sorted(times, key=lambda x: x['forecast'])
-        optimal_times = sorted_times[0:num_options]
+        with phase("snapshot"):
+            matrix = await self._matrix([location], time_range[1])
+            # cut off times outside of time range
+            start, end = time_slots(time_range, matrix.slots)
+        with phase("rank"):
+            cells = matrix.smallest_cells(start, end, num_options)
+        with phase("format"):
+            optimal_times = [matrix.cell(c) for c in cells]
+        CANDIDATES.inc("optimal_time_for_location", amount=max(end - start, 0) * len(matrix.locations))
         return optimal_times[0] if len(optimal_times) == 1 else optimal_times
 
     async def optimal_time_and_location(self, locations: List[str], num_options: int = 1, time_range=[0, 47.5]):
@@ -87,20 +146,15 @@ class Minimiser:
         :param time_range: list defining start and end time range in hours from current time
         :return: dict of optimal time, carbon forecast, carbon index, optimal location. List of dicts if num_options > 1
         """
-        options = []
-        for location in locations:
-            if self.cache:
-                times = self.cache.get("region_forecast_range")[f"('{location}', 47.5)"]
-            else:
-                times = await self.api.region_forecast_range(location, 48)
+        with phase("snapshot"):
+            matrix = await self._matrix(locations, 48)
             # cut off times outside of time range
-            times = times[int(time_range[0]*2):int(time_range[1])*2]
-            for time in times:
-                # results don't come back with location attached
-                time['location'] = location
-            options = options + times
-        sorted_options = sorted(options, key=lambda x: x['forecast'])
-        optimal_options = sorted_options[0:num_options]
+            start, end = time_slots(time_range, matrix.slots)
+        with phase("rank"):
+            cells = matrix.smallest_cells(start, end, num_options)
+        with phase("format"):
+            optimal_options = [matrix.cell(c, location=True) for c in cells]
+        CANDIDATES.inc("optimal_time_and_location", amount=max(end - start, 0) * len(matrix.locations))
         return optimal_options[0] if len(optimal_options) == 1 else optimal_options
 
     async def optimal_time_window_for_location(self, location: str, window_len: float, num_options: int = 1, time_range=[0, 47.5]):
@@ -113,23 +167,10 @@ class Minimiser:
         :param time_range: list defining start and end time range in hours from current time
         :return: dict of optimal time, and average carbon forecast for window. List of dicts if num_options > 1
         """
-        # request times up until max time range
-        if self.cache:
-            times = self.cache.get("region_forecast_range")[f"('{location}', 47.5)"]
-        else:
-            times = await self.api.region_forecast_range(location, time_range[1])
-        # cut off times outside of time range
-        times = times[int(time_range[0]*2):int(time_range[1])*2]
-        costs = []
-        # convert hours into half hours
-        half_hours = int(window_len * 2) if window_len < 48 else 95
-        for window in self._window(times, half_hours):
-            carbon_cost = round(sum([f['forecast'] for f in window])/half_hours)
-            cost = {'time': window[0]['time'], 'forecast': carbon_cost}
-            costs.append(cost)
-        sorted_times = sorted(costs, key=lambda x: x['forecast'])
-        optimal_times = sorted_times[0:num_options]
-        return optimal_times[0] if len(optimal_times) == 1 else optimal_times
+        optimal_options = await self.optimal_time_window_and_location([location], window_len, num_options, time_range)
+        if isinstance(optimal_options, dict):
+            return {'time': optimal_options['time'], 'forecast': optimal_options['forecast']}
+        return [{'time': option['time'], 'forecast': option['forecast']} for option in optimal_options]
 
     async def optimal_time_window_and_location(self, locations: List[str], window_len: float, num_options: int = 1, time_range=[0, 47.5]):
         """
@@ -141,20 +182,158 @@ class Minimiser:
         :param time_range: list defining start and end time range in hours from current time
         :return: dict of optimal location, optimal time, and average carbon forecast for window. List of dicts if num_options > 1
         """
-        costs = []
-        for location in locations:
-            if self.cache:
-                times = self.cache.get("region_forecast_range")[f"('{location}', 47.5)"]
-            else:
-                times = await self.api.region_forecast_range(location, time_range[1])
+        with phase("snapshot"):
+            # request times up until max time range
+            matrix = await self._matrix(locations, time_range[1])
             # cut off times outside of time range
-            times = times[int(time_range[0]*2):int(time_range[1])*2]
-            # convert hours into half hours
-            half_hours = int(window_len * 2) if window_len < 48 else 95
-            for window in self._window(times, half_hours):
-                carbon_cost = round(sum([f['forecast'] for f in window])/half_hours)
-                cost = {'location': location, 'time': window[0]['time'], 'forecast': carbon_cost}
-                costs.append(cost)
-        sorted_options = sorted(costs, key=lambda x: x['forecast'])
-        optimal_options = sorted_options[0:num_options]
+            start, end = time_slots(time_range, matrix.slots)
+        # convert hours into half hours
+        half_hours = int(window_len * 2) if window_len < 48 else 95
+        with phase("lookup"):
+            answers = self.cache.get("answer_index") if self.cache else None
+            windows = answers.lookup(matrix.locations, half_hours, start, end, num_options) if answers else None
+        if windows is None:
+            with phase("evaluate"):
+                costs = matrix.window_averages(start, end, half_hours)
+            CANDIDATES.inc("optimal_time_window_and_location", amount=len(costs))
+            windows_per_location = max(end - start - half_hours + 1, 0)
+            windows = []
+            with phase("rank"):
+                # equivalent to sorted(...)[0:num_options], without sorting every window
+                for w in nsmallest(num_options, range(len(costs)), key=costs.__getitem__):
+                    r, s = divmod(w, windows_per_location)
+                    windows.append((matrix.locations[r], start + s, costs[w]))
+        with phase("format"):
+            optimal_options = [{'location': location, 'time': matrix.times[s], 'forecast': cost} for location, s, cost in windows]
+        return optimal_options[0] if len(optimal_options) == 1 else optimal_options
+
+    async def optimal_times_for_location(self, location: str, num_slots: int, min_run: int = 1, time_range=[0, 47.5]):
+        """
+        Given a location, returns the lowest carbon intensity half hours within the given time range for a job that
+        can be paused and resumed, so need not run in one window
+        :param location: location string, see carbon_api.carbon_api_wrapper.carbon.REGIONS
+        :param num_slots: number of half hours the job needs
+        :param min_run: least number of consecutive half hours the job runs for each time it is resumed
+        :param time_range: list defining start and end time range in hours from current time
+        :return: dict of runs, each a dict of start time, number of half hours and average carbon forecast, with the
+                 total and average carbon forecast over all of them. None if the half hours cannot be found in the time range
+        """
+        matrix = await self._matrix([location], time_range[1])
+        start, end = time_slots(time_range, matrix.slots)
+        cells = matrix.cheapest_cells(0, start, end, num_slots, min_run) if matrix.locations and num_slots > 0 else None
+        CANDIDATES.inc("optimal_times_for_location", amount=max(end - start, 0))
+        if cells is None:
+            return None
+        runs = []
+        for c in cells:
+            if runs and c == runs[-1][-1] + 1:
+                runs[-1].append(c)
+            else:
+                runs.append([c])
+        total = sum(matrix.forecasts[c] for c in cells)
+        return {'runs': [{'time': matrix.times[run[0]], 'half_hours': len(run),
+                          'forecast': round(sum(matrix.forecasts[c] for c in run) / len(run))} for run in runs],
+                'total': total,
+                'forecast': round(total / len(cells))}
+
+    async def optimal_profile_time_for_location(self, location: str, profile: List[float], num_options: int = 1, time_range=[0, 47.5]):
+        """
+        Given a location and the energy a job uses in each half hour, returns the start time with lowest total
+        emissions over the given time range in that location
+        :param location: location string, see carbon_api.carbon_api_wrapper.carbon.REGIONS
+        :param profile: list of kWh used in each half hour of the job
+        :param num_options: define the number of top options returned
+        :param time_range: list defining start and end time range in hours from current time
+        :return: dict of optimal time, and total emissions in gCO2. List of dicts if num_options > 1
+        """
+        optimal_options = await self.optimal_profile_time_and_location([location], profile, num_options, time_range)
+        if isinstance(optimal_options, dict):
+            return {'time': optimal_options['time'], 'emissions': optimal_options['emissions']}
+        return [{'time': option['time'], 'emissions': option['emissions']} for option in optimal_options]
+
+    async def optimal_profile_time_and_location(self, locations: List[str], profile: List[float], num_options: int = 1, time_range=[0, 47.5]):
+        """
+        Given a list of locations and the energy a job uses in each half hour, returns the location and start time
+        with lowest total emissions over the given time range
+        :param locations: list of locations, see carbon_api.carbon_api_wrapper.carbon.REGIONS
+        :param profile: list of kWh used in each half hour of the job
+        :param num_options: define the number of top options returned
+        :param time_range: list defining start and end time range in hours from current time
+        :return: dict of optimal location, optimal time, and total emissions in gCO2. List of dicts if num_options > 1
+        """
+        matrix = await self._matrix(locations, time_range[1])
+        start, end = time_slots(time_range, matrix.slots)
+        emissions = matrix.window_emissions(start, end, profile)
+        CANDIDATES.inc("optimal_profile_time_and_location", amount=len(emissions))
+        windows_per_location = max(end - start - len(profile) + 1, 0)
+        optimal_options = []
+        for w in nsmallest(num_options, range(len(emissions)), key=emissions.__getitem__):
+            r, s = divmod(w, windows_per_location)
+            optimal_options.append({'location': matrix.locations[r], 'time': matrix.times[start + s], 'emissions': round(emissions[w])})
         return optimal_options[0] if len(optimal_options) == 1 else optimal_options
+
+    async def optimal_time_windows(self, queries: List[dict]):
+        """
+        Given a list of window queries, evaluates them all against one snapshot of the forecasts. Queries for the
+        same locations and window length share the average of every window, which each then ranks within its range
+        :param queries: list of dicts of either location or locations, and window_len, num_options and time_range,
+                        see optimal_time_window_for_location and optimal_time_window_and_location
+        :return: async generator of each query's result in order, as returned by the method the query matches
+        """
+        if self.cache:
+            snapshot = self.cache.cache
+            matrix, answers = snapshot["forecast_matrix"], snapshot["answer_index"]
+        else:
+            locations = list(dict.fromkeys(location for query in queries
+                                           for location in query.get("locations", [query.get("location")])))
+            hours = max((query["time_range"][1] for query in queries), default=0)
+            async with self.api.snapshot():
+                forecasts = [await self.api.region_forecast_range(location, hours) for location in locations]
+            matrix, answers = ForecastMatrix.from_forecasts(locations, forecasts), None
+        # matrix and window averages over every slot, by tuple of locations then half hours
+        matrices = {}
+        averages = {}
+        for query in queries:
+            locations = tuple(query.get("locations", [query.get("location")]))
+            if locations not in matrices:
+                matrices[locations] = matrix.select([location for location in locations if location in matrix.rows])
+            selected = matrices[locations]
+            start, end = time_slots(query["time_range"], selected.slots)
+            half_hours = int(query["window_len"] * 2) if query["window_len"] < 48 else 95
+            num_options = query.get("num_options", 1)
+            windows = answers.lookup(selected.locations, half_hours, start, end, num_options) if answers else None
+            if windows is None:
+                if (locations, half_hours) not in averages:
+                    averages[(locations, half_hours)] = selected.window_averages(0, selected.slots, half_hours)
+                costs = averages[(locations, half_hours)]
+                windows_per_location = selected.slots - half_hours + 1
+                candidates = [r * windows_per_location + s for r in range(len(selected.locations))
+                              for s in range(start, end - half_hours + 1)]
+                CANDIDATES.inc("optimal_time_windows", amount=len(candidates))
+                windows = [(selected.locations[w // windows_per_location], w % windows_per_location, costs[w])
+                           for w in nsmallest(num_options, candidates, key=costs.__getitem__)]
+            if "locations" in query:
+                optimal_options = [{'location': location, 'time': selected.times[s], 'forecast': cost} for location, s, cost in windows]
+            else:
+                optimal_options = [{'time': selected.times[s], 'forecast': cost} for _, s, cost in windows]
+            yield optimal_options[0] if len(optimal_options) == 1 else optimal_options
+
+    async def optimal_job_placement(self, jobs: List[dict], capacity: Dict[str, int]):
+        """
+        Given a list of jobs, returns a low carbon location and start time for each, without any location running
+        more jobs at once than its capacity, see placement.place_jobs
+        :param jobs: list of dicts of locations, window_len in hours, and deadline in hours from current time
+        :param capacity: dict of location to number of jobs it can run at once, unlimited if left out
+        :return: list of dicts of location, start time and average carbon forecast for each job in the order given,
+                 None for a job that could not be placed before its deadline
+        """
+        locations = list(dict.fromkeys(location for job in jobs for location in job["locations"]))
+        matrix = await self._matrix(locations, max((job["deadline"] for job in jobs), default=0))
+        placements = []
+        for placement in place_jobs(matrix, jobs, capacity):
+            if placement is None:
+                placements.append(None)
+            else:
+                location, s, cost = placement
+                placements.append({'location': location, 'time': matrix.times[s], 'forecast': cost})
+        return placements
@@ -0,0 +1,64 @@
+# Copyright 2022 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from array import array
+from heapq import merge
+from typing import Dict, List
+from carbon_minimiser.minimiser_api.matrix import ForecastMatrix, time_slots
+
+
+def place_jobs(matrix: ForecastMatrix, jobs: List[dict], capacity: Dict[str, int]) -> List[tuple]:
+    """
+    Greedily places each job in its lowest carbon window that still has room for it, given how many jobs each
+    location can run in the same half hour. Jobs with the least time to spare before their deadline go first,
+    longest first among those. Each job's candidates are a k way merge of its locations' windows ranked by
+    average forecast, shared by every job of the same length, so only the windows ahead of its placement are visited
+    :param jobs: list of dicts of locations, window_len in hours, and deadline in hours from current time
+    :param capacity: dict of location to number of jobs it can run at once, unlimited if left out
+    :return: list of (location, start slot, average forecast) of each job in the order given, None if it could not be placed
+    """
+    slots = matrix.slots
+    # jobs running in each cell, row major like the matrix
+    usage = array('l', [0]) * (len(matrix.locations) * slots)
+    # average forecast of every window, and each row's windows sorted by it, keyed by half hours
+    rankings = {}
+    prepared = []
+    for job in jobs:
+        half_hours = int(job["window_len"] * 2) if job["window_len"] < 48 else 95
+        _, end = time_slots([0, job["deadline"]], slots)
+        rows = [matrix.rows[location] for location in job["locations"] if location in matrix.rows]
+        prepared.append((half_hours, end, rows))
+    placements = [None] * len(jobs)
+    for j in sorted(range(len(jobs)), key=lambda j: (prepared[j][1] - prepared[j][0], -prepared[j][0])):
+        half_hours, end, rows = prepared[j]
+        if not 0 < half_hours <= end:
+            continue
+        if half_hours not in rankings:
+            costs = matrix.window_averages(0, slots, half_hours)
+            windows = slots - half_hours + 1
+            rankings[half_hours] = costs, [sorted(range(r * windows, (r + 1) * windows), key=costs.__getitem__)
+                                           for r in range(len(matrix.locations))]
+        costs, ranked = rankings[half_hours]
+        windows = slots - half_hours + 1
+        candidates = merge(*[filter(lambda w, base=r * windows: w - base + half_hours <= end, ranked[r]) for r in rows],
+                           key=costs.__getitem__)
+        for w in candidates:
+            r, s = divmod(w, windows)
+            limit = capacity.get(matrix.locations[r])
+            first = r * slots + s
+            if limit is None or max(usage[first:first + half_hours]) < limit:
+                for c in range(first, first + half_hours):
+                    usage[c] += 1
+                placements[j] = (matrix.locations[r], s, costs[w])
+                break
+    return placements
@@ -0,0 +1,119 @@
+# Copyright 2022 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from contextlib import nullcontext
+from contextvars import ContextVar
+import cProfile
+import os
+import pstats
+import random
+import time
+
+# (phase, seconds) timed so far in the current request, None when not timing it
+_phases = ContextVar("phases", default=None)
+_untimed = nullcontext()
+
+
+class _Phase:
+    __slots__ = ("name", "phases", "start")
+
+    def __init__(self, name, phases):
+        self.name = name
+        self.phases = phases
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.phases.append((self.name, time.perf_counter() - self.start))
+
+
+def start_timing():
+    """
+    Times the phases of the current request from here on, see phase
+    """
+    _phases.set([])
+
+
+def phase(name):
+    """
+    Context manager timing a phase of the current request, which does nothing unless start_timing was called
+    """
+    phases = _phases.get()
+    return _untimed if phases is None else _Phase(name, phases)
+
+
+def server_timing(total=None):
+    """
+    :param total: seconds taken by the whole request
+    :return: value of a Server-Timing header listing each phase in milliseconds, phases timed more than once
+             are added together. None if the request was not timed
+    """
+    phases = _phases.get()
+    if phases is None:
+        return None
+    durations = {}
+    for name, seconds in phases:
+        durations[name] = durations.get(name, 0) + seconds
+    if total is not None:
+        durations["total"] = total
+    return ", ".join(f"{name};dur={seconds * 1000:.3f}" for name, seconds in durations.items())
+
+
+class RequestProfiler:
+    """
+    Profiles a random sample of requests with cProfile, adding their statistics together and saving them to disk,
+    to be read with pstats or snakeviz. Only one request is profiled at a time, as a profile records whatever else
+    runs on the loop while it is enabled
+    """
+    def __init__(self, rate, path, dump_every=100):
+        """
+        :param rate: fraction of requests profiled
+        :param path: file the statistics are saved to, suffixed with the process id
+        :param dump_every: number of profiled requests between each save
+        """
+        self.rate = rate
+        self.path = path
+        self.dump_every = dump_every
+        self.active = None
+        self.stats = None
+        self.profiled = 0
+
+    def start(self):
+        """
+        :return: a profile if this request is sampled, to pass to stop once it has been answered, otherwise None
+        """
+        if self.active is not None or random.random() >= self.rate:
+            return None
+        self.active = cProfile.Profile()
+        self.active.enable()
+        return self.active
+
+    def stop(self, profile):
+        profile.disable()
+        self.active = None
+        if self.stats is None:
+            self.stats = pstats.Stats(profile)
+        else:
+            self.stats.add(profile)
+        self.profiled += 1
+        if self.profiled % self.dump_every == 0:
+            self.dump()
+
+    def dump(self):
+        if self.stats is None:
+            return
+        # each worker saves its own, and is not necessarily the process that created the profiler
+        path = f"{self.path}.{os.getpid()}"
+        self.stats.dump_stats(f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
@@ -0,0 +1,81 @@
+# Copyright 2022 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+import zlib
+
+
+class ResponseCache:
+    """
+    Least recently used cache of serialised response bodies for one cache generation. Entries are dropped as soon
+    as a newer generation is seen, so a body is never served from an older snapshot than the one it was made from
+    """
+    def __init__(self, size):
+        self.size = size
+        self.generation = None
+        self.entries = OrderedDict()
+
+    def get(self, generation, key):
+        """
+        :param generation: generation of the current cache snapshot, None if there is no cache to key on
+        :return: the cached body, or None
+        """
+        if generation is None:
+            return None
+        if generation != self.generation:
+            self.entries.clear()
+            self.generation = generation
+            return None
+        body = self.entries.get(key)
+        if body is not None:
+            self.entries.move_to_end(key)
+        return body
+
+    def put(self, generation, key, body):
+        if generation is None or generation != self.generation:
+            return
+        self.entries[key] = body
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+def conditional_headers(key, generation, created, refresh_rate):
+    """
+    :param key: the normalised query, see ResponseCache
+    :param created: ISO 8601 local time the cache snapshot was created
+    :param refresh_rate: seconds between cache refreshes
+    :return: ETag, Last-Modified and Cache-Control headers for a response made from the current snapshot
+    """
+    modified = datetime.fromisoformat(created).astimezone(timezone.utc)
+    max_age = max(int(refresh_rate - (datetime.now(timezone.utc) - modified).total_seconds()), 0)
+    return {"ETag": f'"{generation:x}-{zlib.crc32(repr((created, key)).encode()):x}"',
+            "Last-Modified": format_datetime(modified, usegmt=True),
+            "Cache-Control": f"public, max-age={max_age}"}
+
+
+def not_modified(request_headers, headers):
+    """
+    :return: True if the client's copy, per If-None-Match or else If-Modified-Since, is still current
+    """
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        return if_none_match.strip() == "*" or headers["ETag"] in [tag.strip() for tag in if_none_match.split(",")]
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            return parsedate_to_datetime(if_modified_since) >= parsedate_to_datetime(headers["Last-Modified"])
+        except (TypeError, ValueError):
+            return False
+    return False
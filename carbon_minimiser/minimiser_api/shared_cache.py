@@ -0,0 +1,126 @@
+# Copyright 2022 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import mmap
+import os
+import struct
+from carbon_minimiser.minimiser_api.cache import Cache, derive, freeze, without_derived
+from carbon_minimiser.metrics import REGISTRY
+import carbon_minimiser.config as CONFIG
+
+# magic, generation, payload length
+HEADER = struct.Struct("<4sQQ")
+MAGIC = b"CMSC"
+
+
+def create_shared_file(path, size):
+    """
+    Creates (or empties) the file snapshots are shared through, before any worker or refresher maps it
+    """
+    with open(path, "wb") as f:
+        f.truncate(size)
+        f.write(HEADER.pack(MAGIC, 0, 0))
+
+
+class SharedCacheWriter:
+    """
+    Publishes cache snapshots into a memory-mapped file. The generation in the header is odd while a
+    snapshot is being written and even once it is complete, so readers never need a lock
+    """
+    def __init__(self, path):
+        self.file = open(path, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        _, self.generation, _ = HEADER.unpack_from(self.map, 0)
+
+    def publish(self, cache):
+        # derived entries are rebuilt by each reader rather than shared
+        payload = json.dumps(without_derived(cache), separators=(",", ":")).encode()
+        if HEADER.size + len(payload) > len(self.map):
+            raise ValueError(f"Snapshot of {len(payload)} bytes does not fit in shared cache, increase shared_cache_size")
+        HEADER.pack_into(self.map, 0, MAGIC, self.generation + 1, 0)
+        self.map[HEADER.size:HEADER.size + len(payload)] = payload
+        self.generation += 2
+        HEADER.pack_into(self.map, 0, MAGIC, self.generation, len(payload))
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class SharedCache:
+    """
+    Read only view of the snapshot published by the refresher process, with the same get() as Cache.
+    Each worker decodes a snapshot once, when it sees a new generation, and otherwise only reads the header.
+    Derived entries, see cache.derive, are rebuilt at the same time
+    """
+    def __init__(self, path):
+        self.path = path
+        self.map = None
+        self.generation = 0
+        self.snapshot = freeze({})
+
+    @property
+    def cache(self):
+        if self.map is None:
+            if not os.path.exists(self.path):
+                return self.snapshot
+            with open(self.path, "rb") as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _, generation, length = HEADER.unpack_from(self.map, 0)
+        if generation == self.generation or generation % 2:
+            # unchanged, or a new snapshot is still being written
+            return self.snapshot
+        payload = self.map[HEADER.size:HEADER.size + length]
+        if HEADER.unpack_from(self.map, 0)[1] == generation:
+            self.snapshot = freeze(derive(json.loads(payload)))
+            self.generation = generation
+        return self.snapshot
+
+    def get(self, attr):
+        return self.cache[attr]
+
+    def get_generation(self):
+        self.cache  # picks up any newer snapshot
+        return self.generation
+
+    def ready(self):
+        """
+        :return: whether the refresher process has published a snapshot
+        """
+        return self.get_generation() > 0
+
+    def stop_caching(self):
+        """
+        Releases the mapping, refreshing is left to the refresher process
+        """
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+def refresh_shared_cache(refresh_rate, path):
+    """
+    Entry point of the refresher process: keeps the cache up to date and publishes every snapshot to path
+    """
+    writer = SharedCacheWriter(path)
+    cache = Cache(refresh_rate)
+    # the refresher's metrics go out with each snapshot, for the workers to report
+    cache.listeners.append(lambda snapshot: writer.publish(dict(snapshot, metrics=REGISTRY.render())))
+    if CONFIG.snapshot_path:
+        cache.restore(CONFIG.snapshot_path)
+        cache.persist(CONFIG.snapshot_path)
+    try:
+        cache.start_caching()
+    finally:
+        writer.close()
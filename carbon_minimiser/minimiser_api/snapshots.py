@@ -0,0 +1,47 @@
+# Copyright 2022 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import mmap
+import os
+from datetime import datetime
+
+
+def save_snapshot(path, cache):
+    """
+    Writes a cache snapshot to path as compact JSON. The file is replaced atomically, so a reader
+    only ever sees the previous or the new snapshot
+    """
+    payload = json.dumps(cache, separators=(",", ":")).encode()
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def load_snapshot(path, max_age):
+    """
+    :param max_age: seconds after its creation that a snapshot is still usable
+    :return: the snapshot saved at path, or None if there is none or it is older than max_age
+    """
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as snapshot:
+            cache = json.loads(snapshot[:])
+        age = (datetime.now() - datetime.fromisoformat(cache["created"])).total_seconds()
+    except (OSError, ValueError, KeyError) as e:
+        print(f"No cache snapshot loaded from {path}")
+        print(e)
+        return None
+    return cache if age < max_age else None
@@ -0,0 +1,145 @@
+# Copyright 2022 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+from typing import Dict, List
+from carbon_minimiser.minimiser_api.matrix import ForecastMatrix, time_slots
+from carbon_minimiser.minimiser_api.shared_cache import SharedCache
+
+
+def changed_slots(old: ForecastMatrix, new: ForecastMatrix) -> Dict[str, range]:
+    """
+    :return: dict of location to the slots of new whose forecast differs from old, every slot if the time axis
+             moved or the location was added or removed
+    """
+    everything = range(new.slots)
+    if old is None or old.times[:new.slots] != new.times or old.slots < new.slots:
+        return {location: everything for location in set(new.locations) | set(old.locations if old else [])}
+    changed = {location: everything for location in old.locations if location not in new.rows}
+    for r, location in enumerate(new.locations):
+        if location not in old.rows:
+            changed[location] = everything
+            continue
+        o = old.rows[location] * old.slots
+        n = r * new.slots
+        differ = [s for s in range(new.slots) if old.forecasts[o + s] != new.forecasts[n + s] or
+                  old.indexes[o + s] != new.indexes[n + s]]
+        if differ:
+            changed[location] = range(differ[0], differ[-1] + 1)
+    return changed
+
+
+class Subscription:
+    """
+    Standing window queries, with the result last sent for each and the changed results waiting to be sent
+    """
+    def __init__(self, queries: List[dict]):
+        self.queries = queries
+        self.results = [None] * len(queries)
+        # lists of (query number, result)
+        self.changes = asyncio.Queue()
+
+    def update(self, results: List[tuple]):
+        """
+        :param results: list of (query number, result) just evaluated
+        """
+        changes = [(i, result) for i, result in results if result != self.results[i]]
+        for i, result in changes:
+            self.results[i] = result
+        if changes:
+            self.changes.put_nowait(changes)
+
+
+class Subscriptions:
+    """
+    Window queries standing for as long as their subscribers are connected. When a new cache snapshot is
+    published only the queries covering forecasts that changed are evaluated again, all together in one batch,
+    and only results that differ from the last sent are passed on
+    """
+    def __init__(self, minimiser, poll_interval: float = 1):
+        """
+        :param poll_interval: seconds between checks for a new snapshot when reading a shared cache
+        """
+        self.minimiser = minimiser
+        self.poll_interval = poll_interval
+        self.subscriptions = set()
+        # the snapshot every subscription's results are up to date with
+        self.matrix = None
+        self.lock = asyncio.Lock()
+        # running refreshes, kept so they are not garbage collected
+        self.tasks = set()
+
+    def follow(self):
+        """
+        Re-evaluates subscriptions after each refresh. Cache refreshes on the same loop and calls back with
+        each new snapshot, while a SharedCache is checked for a newer generation every poll_interval
+        """
+        cache = self.minimiser.cache
+        if isinstance(cache, SharedCache):
+            self.start(self.poll())
+        elif cache:
+            cache.listeners.append(lambda snapshot: self.start(self.refresh()))
+
+    def start(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+
+    async def poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            await self.refresh()
+
+    async def add(self, queries: List[dict]) -> Subscription:
+        """
+        :param queries: list of queries, see Minimiser.optimal_time_windows
+        :return: the subscription, with every query's current result waiting to be sent
+        """
+        async with self.lock:
+            if self.matrix is None:
+                self.matrix = self.minimiser.cache.get("forecast_matrix")
+            subscription = Subscription(queries)
+            subscription.update(list(enumerate([result async for result in self.minimiser.optimal_time_windows(queries)])))
+            self.subscriptions.add(subscription)
+            return subscription
+
+    def remove(self, subscription: Subscription):
+        self.subscriptions.discard(subscription)
+
+    async def refresh(self):
+        async with self.lock:
+            matrix = self.minimiser.cache.get("forecast_matrix")
+            if matrix is self.matrix:
+                return
+            changed = changed_slots(self.matrix, matrix)
+            self.matrix = matrix
+            affected = []
+            for subscription in self.subscriptions:
+                for i, query in enumerate(subscription.queries):
+                    start, end = time_slots(query["time_range"], matrix.slots)
+                    slots = [changed[location] for location in query.get("locations", [query.get("location")])
+                             if location in changed]
+                    if any(s.start < end and start < s.stop for s in slots):
+                        affected.append((subscription, i))
+            if not affected:
+                return
+            results = [result async for result in self.minimiser.optimal_time_windows([s.queries[i] for s, i in affected])]
+            updates = {}
+            for (subscription, i), result in zip(affected, results):
+                updates.setdefault(subscription, []).append((i, result))
+            for subscription, results in updates.items():
+                subscription.update(results)
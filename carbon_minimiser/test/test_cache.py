@@ -0,0 +1,183 @@
+# Copyright 2022 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import os
+import tempfile
+from datetime import datetime, timedelta
+from unittest import mock, IsolatedAsyncioTestCase
+from carbon_minimiser.minimiser_api.cache import Cache, LOCATIONS, thaw
+from aiohttp.test_utils import TestServer
+from carbon_minimiser.carbon_api.carbon_api_wrapper.carbon import CarbonAPI
+from carbon_minimiser.carbon_api.stub_server import create_stub_app
+import carbon_minimiser.config as CONFIG
+
+FUNCTIONS = ["current_national_intensity", "current_national_mix", "current_region_intensity", "current_region_mix",
+             "national_forecast_single", "national_forecast_range", "region_forecast_single", "region_forecast_range",
+             "regions_forecast_single", "regions_forecast_range"]
+
+
+def named_mock(name, **kwargs):
+    request = mock.AsyncMock(**kwargs)
+    request.__name__ = name
+    return request
+
+
+class TestCache(IsolatedAsyncioTestCase):
+    async def test_create_cache(self):
+        for bulk_threshold in [len(LOCATIONS), 3]:
+            with self.subTest(bulk_threshold=bulk_threshold):
+                await self._test_create_cache(bulk_threshold)
+
+    async def test_create_cache_from_stub_server(self):
+        server = TestServer(create_stub_app(latency=0.01))
+        await server.start_server()
+        self.addAsyncCleanup(server.close)
+        for bulk_threshold in [len(LOCATIONS), 3]:
+            with mock.patch.object(CONFIG, "api_url", str(server.make_url("/"))):
+                cache = Cache(1800, bulk_threshold=bulk_threshold)
+            cache.gather_functions()
+            self.assertEqual(await cache.create_cache(), 0)
+            await cache.carbonAPI.close()
+            self.assertEqual(cache.get("forecast_matrix").locations, LOCATIONS)
+            self.assertEqual(cache.get("forecast_matrix").slots, 96)
+
+    async def _test_create_cache(self, bulk_threshold):
+        in_flight = 0
+        max_in_flight = 0
+
+        def response(name, args):
+            # forecast ranges echo their arguments as times, everything else echoes its arguments
+            if name.endswith("forecast_range"):
+                return [{'time': args, 'forecast': 10, 'index': 'low'}, {'time': args, 'forecast': 20, 'index': 'low'}]
+            return args
+
+        def fake(name):
+            async def fake_request(*args):
+                nonlocal in_flight, max_in_flight
+                in_flight += 1
+                max_in_flight = max(in_flight, max_in_flight)
+                await asyncio.sleep(0.01)
+                in_flight -= 1
+                if name.startswith("regions_"):
+                    return {region: response(name, (region, args[1])) for region in args[0]}
+                return response(name, args)
+
+            return named_mock(name, side_effect=fake_request)
+
+        cache = Cache(1800, concurrency=4, bulk_threshold=bulk_threshold)
+        fakes = {name: fake(name) for name in FUNCTIONS}
+        with mock.patch.multiple(CarbonAPI, **fakes):
+            cache.gather_functions()
+            await cache.create_cache()
+        self.assertEqual(max_in_flight, 4)
+        self.assertEqual(cache.get("current_national_intensity"), ())
+        self.assertEqual(cache.get("national_forecast_range")["47.5"][0]['time'], (47.5,))
+        self.assertEqual(cache.get("region_forecast_range")[f"('{LOCATIONS[0]}', 47.5)"][0]['time'], (LOCATIONS[0], 47.5))
+        self.assertEqual(cache.get("forecast_matrix").locations, LOCATIONS)
+        self.assertEqual(list(cache.get("forecast_matrix").prefix[0:3]), [0, 10, 30])
+        self.assertEqual(cache.get("region_forecast_single")[f"('{LOCATIONS[-1]}', 47.5)"], (LOCATIONS[-1], 47.5))
+        self.assertIsNotNone(cache.refresh_duration)
+        bulk = bulk_threshold < len(LOCATIONS)
+        self.assertEqual(fakes["regions_forecast_range"].call_count, 1 if bulk else 0)
+        self.assertEqual(fakes["region_forecast_range"].call_count, 0 if bulk else len(LOCATIONS))
+
+    async def test_persist_and_restore(self):
+        forecast = [{'time': '+00:30', 'forecast': 10, 'index': 'low'}]
+        snapshot = {"created": datetime.now().isoformat(),
+                    "current_region_intensity": {"WALES": (10, 'low')},
+                    "region_forecast_range": {"('WALES', 47.5)": forecast}}
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "snapshot")
+            cache = Cache(1800)
+            cache.restore(path)
+            self.assertEqual(cache.cache, {})
+            cache.persist(path)
+            cache.publish(snapshot)
+            restored = Cache(1800)
+            restored.restore(path)
+            self.assertEqual(thaw(restored.get("region_forecast_range")), {"('WALES', 47.5)": forecast})
+            self.assertEqual(restored.get("forecast_matrix").locations, ["WALES"])
+            self.assertEqual(restored.get_generation(), 1)
+            # snapshots beyond the forecast horizon are not served
+            cache.publish(dict(snapshot, created=(datetime.now() - timedelta(hours=48)).isoformat()))
+            expired = Cache(1800)
+            expired.restore(path)
+            self.assertEqual(expired.cache, {})
+
+    async def test_published_snapshots_are_read_only(self):
+        cache = Cache(1800)
+        self.assertFalse(cache.ready())
+        snapshot = {"created": datetime.now().isoformat(),
+                    "region_forecast_range": {"('WALES', 47.5)": [{'time': '+00:30', 'forecast': 10, 'index': 'low'}]}}
+        cache.publish(snapshot)
+        self.assertTrue(cache.ready())
+        forecasts = cache.get("region_forecast_range")
+        with self.assertRaises(TypeError):
+            forecasts["('WALES', 47.5)"][0]['location'] = "WALES"
+        with self.assertRaises(AttributeError):
+            forecasts["('WALES', 47.5)"].append({})
+        # the published snapshot is a copy, so the dict it came from can change without affecting it
+        snapshot["created"] = None
+        self.assertIsNotNone(cache.get("created"))
+
+    async def test_run_refreshes_on_running_loop(self):
+        fakes = {name: named_mock(name, return_value=(1, 'low')) for name in FUNCTIONS}
+        fakes["region_forecast_range"] = named_mock("region_forecast_range",
+                                                    return_value=[{'time': '+00:30', 'forecast': 10, 'index': 'low'}])
+        cache = Cache(1800)
+        published = []
+        cache.listeners.append(lambda snapshot: published.append(asyncio.get_running_loop()))
+        with mock.patch.multiple(CarbonAPI, **fakes):
+            cache.gather_functions()
+            task = asyncio.create_task(cache.run())
+            while not cache.ready():
+                await asyncio.sleep(0.01)
+            cache.stop_caching()
+            await task
+        self.assertEqual(published, [asyncio.get_running_loop()])
+        self.assertTrue(task.done())
+
+    async def test_failed_entries_keep_last_good_value(self):
+        failing = set()
+
+        async def forecast(region, hours):
+            if region in failing:
+                raise ConnectionError()
+            return [{'time': '+00:30', 'forecast': 20 if failing else 10, 'index': 'low'}]
+
+        fakes = {name: named_mock(name, return_value=(1, 'low')) for name in FUNCTIONS}
+        fakes["region_forecast_range"] = named_mock("region_forecast_range", side_effect=forecast)
+        cache = Cache(1800, bulk_threshold=len(LOCATIONS), max_staleness=600)
+        with mock.patch.multiple(CarbonAPI, **fakes):
+            cache.gather_functions()
+            self.assertEqual(await cache.create_cache(), 0)
+            collected = cache.get("updated")["region_forecast_range"]["('LONDON', 47.5)"]
+            failing.update(["LONDON", "WALES"])
+            self.assertEqual(await cache.create_cache(), 2)
+            forecasts = cache.get("region_forecast_range")
+            self.assertEqual(forecasts["('LONDON', 47.5)"][0]['forecast'], 10)
+            self.assertEqual(forecasts["('S_WALES', 47.5)"][0]['forecast'], 20)
+            self.assertEqual(cache.get("updated")["region_forecast_range"]["('LONDON', 47.5)"], collected)
+            # beyond max_staleness a failed entry is no longer served
+            with mock.patch("time.time", return_value=collected + 601):
+                await cache.create_cache()
+            self.assertIsNone(cache.get("region_forecast_range")["('LONDON', 47.5)"])
+            self.assertNotIn("LONDON", cache.get("forecast_matrix").locations)
+            # when everything fails the current cache is kept
+            generation = cache.get_generation()
+            failing.update(LOCATIONS)
+            for name in FUNCTIONS:
+                fakes[name].return_value = None
+            await cache.create_cache()
+            self.assertEqual(cache.get_generation(), generation)
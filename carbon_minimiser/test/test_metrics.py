@@ -0,0 +1,49 @@
+# Copyright 2022 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from unittest import TestCase
+from carbon_minimiser.metrics import Counter, Gauge, Histogram, Registry
+
+
+class TestMetrics(TestCase):
+    def test_render(self):
+        registry = Registry()
+        counter = Counter("requests_total", "Requests", ["route"], registry)
+        Gauge("age_seconds", "Age", registry=registry, function=lambda: 12.5)
+        Gauge("unset", "Nothing recorded", registry=registry, function=lambda: None)
+        histogram = Histogram("latency_seconds", "Latency", ["route"], registry, buckets=(0.1, 1))
+        counter.inc('/a "b"')
+        counter.inc('/a "b"', amount=2)
+        histogram.observe(0.05, "/a")
+        histogram.observe(0.5, "/a")
+        histogram.observe(5, "/a")
+        self.assertEqual(registry.render(),
+                         '# HELP requests_total Requests\n'
+                         '# TYPE requests_total counter\n'
+                         'requests_total{route="/a \\"b\\""} 3\n'
+                         '# HELP age_seconds Age\n'
+                         '# TYPE age_seconds gauge\n'
+                         'age_seconds 12.5\n'
+                         '# HELP latency_seconds Latency\n'
+                         '# TYPE latency_seconds histogram\n'
+                         'latency_seconds_bucket{route="/a",le="0.1"} 1\n'
+                         'latency_seconds_bucket{route="/a",le="1"} 2\n'
+                         'latency_seconds_bucket{route="/a",le="+Inf"} 3\n'
+                         'latency_seconds_sum{route="/a"} 5.55\n'
+                         'latency_seconds_count{route="/a"} 3\n')
+
+    def test_nothing_recorded(self):
+        registry = Registry()
+        Counter("requests_total", "Requests", registry=registry)
+        Histogram("latency_seconds", "Latency", registry=registry)
+        self.assertEqual(registry.render(), "")
@@ -11,8 +11,13 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from itertools import combinations, groupby
+from random import Random
 from unittest import mock, IsolatedAsyncioTestCase
 from carbon_minimiser.minimiser_api.minimiser import Minimiser
+from carbon_minimiser.minimiser_api.cache import Cache, derive
+from carbon_minimiser.minimiser_api.matrix import ForecastMatrix, time_slots
+import carbon_minimiser.config as CONFIG
 from carbon_minimiser.carbon_api.carbon_api_wrapper.carbon import CarbonAPI
 
 
@@ -91,3 +96,217 @@ class TestCarbonMinimiser(IsolatedAsyncioTestCase):
             result = await self.min.optimal_time_window_and_location(["a", "b", "c"], 1.5)
             expected_result = {'location': 'b', 'time': '+00:30', 'forecast': 107}
             self.assertEqual(result, expected_result)
+
+    async def test_optimal_time_window_matches_full_scan(self):
+        random = Random(1)
+        data = [[{'forecast': random.randint(0, 20), 'index': 'moderate', 'time': f"+{t}"} for t in range(96)]
+                for location in range(3)]
+        for window_len, num_options, time_range in [(0.5, 5, [0, 95]), (2, 10, [3.5, 10]), (4.5, 3, [1, 30]), (30, 2, [0, 47.5])]:
+            half_hours = int(window_len * 2)
+            expected = []
+            for location, times in zip(["a", "b", "c"], data):
+                times = times[int(time_range[0]*2):int(time_range[1])*2]
+                for i in range(len(times) - half_hours + 1):
+                    window = times[i:i + half_hours]
+                    expected.append({'location': location, 'time': window[0]['time'],
+                                     'forecast': round(sum([f['forecast'] for f in window])/half_hours)})
+            expected = sorted(expected, key=lambda x: x['forecast'])[0:num_options]
+            with mock.patch.object(CarbonAPI, "region_forecast_range", side_effect=data):
+                result = await self.min.optimal_time_window_and_location(["a", "b", "c"], window_len,
+                                                                         num_options=num_options, time_range=time_range)
+                self.assertEqual(result, expected)
+
+    async def test_optimal_time_and_location_matches_full_sort(self):
+        random = Random(2)
+        data = [[{'forecast': random.randint(0, 10), 'index': 'moderate', 'time': f"+{t}"} for t in range(96)]
+                for location in range(3)]
+        for num_options, time_range in [(1, [0, 95]), (20, [3.5, 10]), (300, [0, 47.5]), (0, [1, 2])]:
+            expected = []
+            for location, times in zip(["a", "b", "c"], data):
+                for time in times[int(time_range[0]*2):int(time_range[1])*2]:
+                    expected.append(dict(time, location=location))
+            expected = sorted(expected, key=lambda x: x['forecast'])[0:num_options]
+            with mock.patch.object(CarbonAPI, "region_forecast_range", side_effect=data):
+                result = await self.min.optimal_time_and_location(["a", "b", "c"], num_options=num_options,
+                                                                  time_range=time_range)
+                self.assertEqual(result, expected[0] if len(expected) == 1 else expected)
+
+    async def test_cached_forecast_matrix(self):
+        minimiser = Minimiser()
+        minimiser.cache = Cache(1800)
+        london = [{'time': '+00:30', 'forecast': 231, 'index': 'moderate'},
+                  {'time': '+01:00', 'forecast': 23, 'index': 'low'}]
+        wales = [{'time': '+00:30', 'forecast': 23, 'index': 'low'},
+                 {'time': '+01:00', 'forecast': 253, 'index': 'moderate'}]
+        minimiser.cache.cache = derive({"current_region_intensity": {"LONDON": (231, 'moderate'), "WALES": (23, 'low')},
+                                        "region_forecast_range": {"('LONDON', 47.5)": london, "('WALES', 47.5)": wales}})
+        result = await minimiser.optimal_location_now(["LONDON", "WALES"])
+        self.assertEqual(result, {'location': 'WALES', 'forecast': 23, 'index': 'low'})
+        result = await minimiser.optimal_time_and_location(["LONDON", "WALES"], num_options=3)
+        self.assertEqual(result, [{'time': '+01:00', 'forecast': 23, 'index': 'low', 'location': 'LONDON'},
+                                  {'time': '+00:30', 'forecast': 23, 'index': 'low', 'location': 'WALES'},
+                                  {'time': '+00:30', 'forecast': 231, 'index': 'moderate', 'location': 'LONDON'}])
+        result = await minimiser.optimal_time_window_and_location(["WALES", "LONDON"], 1)
+        self.assertEqual(result, {'location': 'LONDON', 'time': '+00:30', 'forecast': 127})
+        # cached forecasts are left untouched
+        self.assertNotIn('location', london[1])
+
+    async def test_materialised_answers_match_computed(self):
+        random = Random(3)
+        locations = ["LONDON", "WALES", "SCOTLAND"]
+        snapshot = {"current_region_intensity": {},
+                    "region_forecast_range": {f"('{location}', 47.5)": [{'forecast': random.randint(0, 30), 'index': 'low',
+                                                                         'time': f"+{t}"} for t in range(96)]
+                                              for location in locations}}
+        computed = Minimiser()
+        computed.cache = Cache(1800)
+        computed.cache.cache = derive(dict(snapshot))
+        materialised = Minimiser()
+        materialised.cache = Cache(1800)
+        with mock.patch.object(CONFIG, "materialise", True):
+            materialised.cache.cache = derive(dict(snapshot))
+        answers = materialised.cache.get("answer_index")
+        self.assertTrue(answers.complete)
+        self.assertGreater(answers.size, 0)
+        for window_len, num_options, time_range in [(0.5, 5, [0, 95]), (3, 10, [3.5, 10]), (20, 4, [1, 47.5]), (47.5, 1, [0, 95])]:
+            for query in [locations, ["WALES"]]:
+                expected = await computed.optimal_time_window_and_location(query, window_len, num_options, time_range)
+                result = await materialised.optimal_time_window_and_location(query, window_len, num_options, time_range)
+                self.assertEqual(result, expected)
+
+    def test_materialise_budget(self):
+        snapshot = {"current_region_intensity": {},
+                    "region_forecast_range": {"('WALES', 47.5)": [{'forecast': t, 'index': 'low', 'time': f"+{t}"}
+                                                                  for t in range(96)]}}
+        with mock.patch.multiple(CONFIG, materialise=True, materialise_budget=0):
+            answers = derive(snapshot)["answer_index"]
+        self.assertFalse(answers.complete)
+        self.assertIsNone(answers.lookup(["WALES"], 1, 0, 96, 1))
+
+    def test_forecast_matrix_aligns_stale_rows(self):
+        fresh = [{'time': '+01:00', 'forecast': 20, 'index': 'low'}, {'time': '+01:30', 'forecast': 30, 'index': 'low'}]
+        stale = [{'time': '+00:30', 'forecast': 1, 'index': 'low'}, {'time': '+01:00', 'forecast': 2, 'index': 'low'},
+                 {'time': '+01:30', 'forecast': 3, 'index': 'low'}]
+        matrix = ForecastMatrix.from_forecasts(["a", "b"], [fresh, stale])
+        self.assertEqual(matrix.times, ['+01:00', '+01:30'])
+        self.assertEqual(list(matrix.forecasts), [20, 30, 2, 3])
+
+    async def test_unavailable_locations_are_skipped(self):
+        minimiser = Minimiser()
+        minimiser.cache = Cache(1800)
+        minimiser.cache.cache = derive({"current_region_intensity": {"LONDON": None, "WALES": (23, 'low')},
+                                        "region_forecast_range": {"('LONDON', 47.5)": None,
+                                                                  "('WALES', 47.5)": [{'time': '+00:30', 'forecast': 23,
+                                                                                       'index': 'low'}]}})
+        result = await minimiser.optimal_time_and_location(["LONDON", "WALES"])
+        self.assertEqual(result['location'], 'WALES')
+        self.assertEqual(await minimiser.optimal_time_for_location("LONDON"), [])
+
+    async def test_batch_matches_single_queries(self):
+        random = Random(4)
+        locations = ["LONDON", "WALES", "SCOTLAND"]
+        snapshot = {"current_region_intensity": {},
+                    "region_forecast_range": {f"('{location}', 47.5)": [{'forecast': random.randint(0, 30), 'index': 'low',
+                                                                         'time': f"+{t}"} for t in range(96)]
+                                              for location in locations}}
+        queries = [{"locations": locations, "window_len": 0.5, "num_options": 5, "time_range": [0, 95]},
+                   {"location": "WALES", "window_len": 3, "num_options": 10, "time_range": [3.5, 10]},
+                   {"locations": locations, "window_len": 3, "num_options": 1, "time_range": [1, 47.5]},
+                   {"location": "WALES", "window_len": 3, "num_options": 2, "time_range": [0, 2]},
+                   {"location": "LONDON", "window_len": 47.5, "num_options": 1, "time_range": [0, 95]}]
+        for materialise in [False, True]:
+            minimiser = Minimiser()
+            minimiser.cache = Cache(1800)
+            with mock.patch.object(CONFIG, "materialise", materialise):
+                minimiser.cache.cache = derive(dict(snapshot))
+            results = [result async for result in minimiser.optimal_time_windows(queries)]
+            for query, result in zip(queries, results):
+                query = dict(query)
+                if "location" in query:
+                    expected = await minimiser.optimal_time_window_for_location(query.pop("location"), **query)
+                else:
+                    expected = await minimiser.optimal_time_window_and_location(query.pop("locations"), **query)
+                self.assertEqual(result, expected)
+
+    async def test_job_placement(self):
+        minimiser = Minimiser()
+        minimiser.cache = Cache(1800)
+        forecasts = {"LONDON": [5, 1, 1, 9, 2, 2], "WALES": [3, 3, 3, 3, 3, 3]}
+        minimiser.cache.cache = derive({"current_region_intensity": {},
+                                        "region_forecast_range": {f"('{location}', 47.5)": [{'time': f"+{t}", 'forecast': f, 'index': 'low'}
+                                                                                            for t, f in enumerate(values)]
+                                                                  for location, values in forecasts.items()}})
+        jobs = [{"locations": ["LONDON", "WALES"], "window_len": 1, "deadline": 3}] * 3
+        # unlimited capacity places every job like a single query
+        single = await minimiser.optimal_time_window_and_location(["LONDON", "WALES"], 1, time_range=[0, 3])
+        self.assertEqual(await minimiser.optimal_job_placement(jobs, {}), [single] * 3)
+        # one at a time in London fills its best windows, and then Wales
+        self.assertEqual(await minimiser.optimal_job_placement(jobs, {"LONDON": 1}),
+                         [{'location': 'LONDON', 'time': '+1', 'forecast': 1},
+                          {'location': 'LONDON', 'time': '+4', 'forecast': 2},
+                          {'location': 'WALES', 'time': '+0', 'forecast': 3}])
+        # the job with the earlier deadline is placed first, and one too long for its deadline is not placed
+        self.assertEqual(await minimiser.optimal_job_placement([{"locations": ["LONDON"], "window_len": 0.5, "deadline": 3},
+                                                                {"locations": ["LONDON"], "window_len": 0.5, "deadline": 1},
+                                                                {"locations": ["LONDON"], "window_len": 2, "deadline": 1}],
+                                                               {"LONDON": 1}),
+                         [{'location': 'LONDON', 'time': '+2', 'forecast': 1},
+                          {'location': 'LONDON', 'time': '+1', 'forecast': 1},
+                          None])
+
+    async def test_optimal_profile_matches_full_scan(self):
+        random = Random(5)
+        locations = ["LONDON", "WALES", "SCOTLAND"]
+        forecasts = {location: [random.randint(0, 300) for _ in range(96)] for location in locations}
+        minimiser = Minimiser()
+        minimiser.cache = Cache(1800)
+        minimiser.cache.cache = derive({"current_region_intensity": {},
+                                        "region_forecast_range": {f"('{location}', 47.5)": [{'time': f"+{t}", 'forecast': f, 'index': 'low'}
+                                                                                            for t, f in enumerate(values)]
+                                                                  for location, values in forecasts.items()}})
+        for profile, num_options, time_range in [([1.5], 3, [0, 95]), ([0.5, 2, 2, 2, 0.5], 5, [2, 20]), ([1] * 30, 2, [0, 47.5])]:
+            start, end = time_slots(time_range, 96)
+            emissions = [(sum(forecasts[location][s + i] * kwh for i, kwh in enumerate(profile)), location, s)
+                         for location in locations for s in range(start, end - len(profile) + 1)]
+            expected = [{'location': location, 'time': f"+{s}", 'emissions': round(total)}
+                        for total, location, s in sorted(emissions, key=lambda e: e[0])[:num_options]]
+            result = await minimiser.optimal_profile_time_and_location(locations, profile, num_options, time_range)
+            self.assertEqual(result, expected)
+        result = await minimiser.optimal_profile_time_and_location(["WALES"], [1, 1])
+        self.assertEqual(await minimiser.optimal_profile_time_for_location("WALES", [1, 1]),
+                         {'time': result['time'], 'emissions': result['emissions']})
+
+    def test_cheapest_cells_matches_full_search(self):
+        random = Random(6)
+        for _ in range(30):
+            forecasts = [random.randint(0, 20) for _ in range(12)]
+            matrix = ForecastMatrix.from_forecasts(["WALES", "LONDON"], [[{'time': f"+{t}", 'forecast': 0, 'index': 'low'} for t in range(12)],
+                                                                         [{'time': f"+{t}", 'forecast': f, 'index': 'low'}
+                                                                          for t, f in enumerate(forecasts)]])
+            start, end, count, min_run = 1, 11, random.randint(1, 8), random.randint(1, 4)
+
+            def runs_long_enough(slots):
+                return all(len(list(run)) >= min_run for _, run in groupby(enumerate(slots), lambda e: e[1] - e[0]))
+            allowed = [sum(forecasts[s] for s in slots) for slots in combinations(range(start, end), count) if runs_long_enough(slots)]
+            cells = matrix.cheapest_cells(1, start, end, count, min_run)
+            if not allowed:
+                self.assertIsNone(cells)
+                continue
+            slots = [c - 12 for c in cells]
+            self.assertEqual(len(set(slots)), count)
+            self.assertTrue(all(start <= s < end for s in slots))
+            self.assertTrue(runs_long_enough(slots))
+            self.assertEqual(sum(forecasts[s] for s in slots), min(allowed))
+
+    async def test_optimal_times_for_location(self):
+        minimiser = Minimiser()
+        minimiser.cache = Cache(1800)
+        minimiser.cache.cache = derive({"current_region_intensity": {},
+                                        "region_forecast_range": {"('WALES', 47.5)": [{'time': f"+{t}", 'forecast': f, 'index': 'low'}
+                                                                                      for t, f in enumerate([9, 1, 8, 2, 2, 9, 3, 9])]}})
+        self.assertEqual(await minimiser.optimal_times_for_location("WALES", 3),
+                         {'runs': [{'time': '+1', 'half_hours': 1, 'forecast': 1}, {'time': '+3', 'half_hours': 2, 'forecast': 2}],
+                          'total': 5, 'forecast': 2})
+        self.assertEqual(await minimiser.optimal_times_for_location("WALES", 4, min_run=2),
+                         {'runs': [{'time': '+1', 'half_hours': 4, 'forecast': 3}], 'total': 13, 'forecast': 3})
+        self.assertIsNone(await minimiser.optimal_times_for_location("WALES", 4, time_range=[0, 1.5]))
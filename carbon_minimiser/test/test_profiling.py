@@ -0,0 +1,58 @@
+# Copyright 2022 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import contextvars
+import os
+import pstats
+import tempfile
+from unittest import TestCase
+from carbon_minimiser.minimiser_api.profiling import RequestProfiler, phase, server_timing, start_timing
+
+
+def timed_request():
+    start_timing()
+    with phase("parse"):
+        pass
+    with phase("rank"):
+        pass
+    with phase("parse"):
+        pass
+    return server_timing(0.002)
+
+
+class TestProfiling(TestCase):
+    def test_server_timing(self):
+        # each request runs in its own context, as a task does
+        timing = contextvars.copy_context().run(timed_request)
+        self.assertRegex(timing, r"^parse;dur=\d+\.\d{3}, rank;dur=\d+\.\d{3}, total;dur=2\.000$")
+
+    def test_untimed(self):
+        def untimed_request():
+            with phase("parse"):
+                pass
+            return server_timing(0.002)
+        self.assertIsNone(contextvars.copy_context().run(untimed_request))
+
+    def test_request_profiler(self):
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = RequestProfiler(1, os.path.join(directory, "profile"), dump_every=2)
+            for _ in range(2):
+                profile = profiler.start()
+                # one request at a time
+                self.assertIsNone(profiler.start())
+                sorted(range(1000), key=lambda x: -x)
+                profiler.stop(profile)
+            path = os.path.join(directory, f"profile.{os.getpid()}")
+            self.assertTrue(os.path.exists(path))
+            self.assertGreater(pstats.Stats(path).total_calls, 2000)
+            self.assertIsNone(RequestProfiler(0, path).start())
@@ -0,0 +1,65 @@
+# Copyright 2022 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from datetime import datetime, timedelta
+from unittest import TestCase
+from carbon_minimiser.minimiser_api.responses import ResponseCache, conditional_headers, not_modified
+
+
+class TestResponseCache(TestCase):
+    def test_lru_eviction(self):
+        responses = ResponseCache(2)
+        self.assertIsNone(responses.get(1, "a"))
+        responses.put(1, "a", b"1")
+        responses.put(1, "b", b"2")
+        self.assertEqual(responses.get(1, "a"), b"1")
+        responses.put(1, "c", b"3")
+        self.assertIsNone(responses.get(1, "b"))
+        self.assertEqual(responses.get(1, "a"), b"1")
+        self.assertEqual(responses.get(1, "c"), b"3")
+
+    def test_new_generation_invalidates(self):
+        responses = ResponseCache(2)
+        responses.get(1, "a")
+        responses.put(1, "a", b"1")
+        self.assertIsNone(responses.get(2, "a"))
+        # a body computed from the older snapshot is not stored under the newer generation
+        responses.put(1, "a", b"1")
+        self.assertIsNone(responses.get(2, "a"))
+
+    def test_no_generation(self):
+        responses = ResponseCache(2)
+        responses.put(None, "a", b"1")
+        self.assertIsNone(responses.get(None, "a"))
+
+
+class TestConditionalRequests(TestCase):
+    def test_conditional_headers(self):
+        created = (datetime.now() - timedelta(seconds=600)).isoformat()
+        headers = conditional_headers(("optimise", 1), 3, created, 1800)
+        self.assertTrue(headers["ETag"].startswith('"3-'))
+        self.assertEqual(headers["ETag"], conditional_headers(("optimise", 1), 3, created, 1800)["ETag"])
+        self.assertNotEqual(headers["ETag"], conditional_headers(("optimise", 2), 3, created, 1800)["ETag"])
+        self.assertTrue(headers["Last-Modified"].endswith("GMT"))
+        self.assertIn(headers["Cache-Control"], ["public, max-age=1200", "public, max-age=1199"])
+        self.assertEqual(conditional_headers(("optimise", 1), 3, created, 60)["Cache-Control"], "public, max-age=0")
+
+    def test_not_modified(self):
+        headers = conditional_headers(("optimise", 1), 3, datetime.now().isoformat(), 1800)
+        self.assertFalse(not_modified({}, headers))
+        self.assertTrue(not_modified({"if-none-match": f'"a", {headers["ETag"]}'}, headers))
+        self.assertFalse(not_modified({"if-none-match": '"a"'}, headers))
+        self.assertTrue(not_modified({"if-modified-since": headers["Last-Modified"]}, headers))
+        self.assertFalse(not_modified({"if-modified-since": "Mon, 01 Jan 2024 00:00:00 GMT"}, headers))
+        # If-None-Match takes precedence
+        self.assertFalse(not_modified({"if-none-match": '"a"', "if-modified-since": headers["Last-Modified"]}, headers))
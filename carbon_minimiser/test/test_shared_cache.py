@@ -0,0 +1,55 @@
+# Copyright 2022 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import tempfile
+from unittest import TestCase
+from carbon_minimiser.minimiser_api.shared_cache import create_shared_file, SharedCache, SharedCacheWriter
+
+
+
+def make_snapshot(created):
+    return {"created": created,
+            "current_region_intensity": {"LONDON": [100, "moderate"]},
+            "region_forecast_range": {"('LONDON', 47.5)": [{"time": "+00:00", "forecast": 100, "index": "moderate"}]}}
+
+
+class TestSharedCache(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "cache")
+        create_shared_file(self.path, 4096)
+        self.writer = SharedCacheWriter(self.path)
+        self.reader = SharedCache(self.path)
+
+    def tearDown(self):
+        self.reader.stop_caching()
+        self.writer.close()
+        self.dir.cleanup()
+
+    def test_publish(self):
+        with self.assertRaises(KeyError):
+            self.reader.get("created")
+        self.writer.publish(make_snapshot("1"))
+        self.assertEqual(self.reader.get("created"), "1")
+        self.assertEqual(self.reader.get("forecast_matrix").locations, ["LONDON"])
+        snapshot = self.reader.cache
+        # unchanged generation is served without decoding again
+        self.assertIs(self.reader.cache, snapshot)
+        self.writer.publish(make_snapshot("2"))
+        self.assertEqual(self.reader.get("created"), "2")
+        self.assertEqual(self.reader.generation, 4)
+
+    def test_snapshot_too_large(self):
+        with self.assertRaises(ValueError):
+            self.writer.publish(make_snapshot("x" * 4096))
@@ -0,0 +1,65 @@
+# Copyright 2022 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from unittest import mock, IsolatedAsyncioTestCase
+from carbon_minimiser.minimiser_api.cache import Cache, derive
+from carbon_minimiser.minimiser_api.minimiser import Minimiser
+from carbon_minimiser.minimiser_api.subscriptions import Subscriptions, changed_slots
+
+
+def make_snapshot(forecasts, first=0):
+    return derive({"current_region_intensity": {},
+                   "region_forecast_range": {f"('{location}', 47.5)": [{'time': f"+{first + t}", 'forecast': f, 'index': 'low'}
+                                                                       for t, f in enumerate(values)]
+                                             for location, values in forecasts.items()}})
+
+
+class TestSubscriptions(IsolatedAsyncioTestCase):
+    def test_changed_slots(self):
+        old = make_snapshot({"LONDON": [1, 2, 3, 4], "WALES": [1, 2, 3, 4]})["forecast_matrix"]
+        self.assertEqual(changed_slots(None, old), {"LONDON": range(4), "WALES": range(4)})
+        self.assertEqual(changed_slots(old, old), {})
+        new = make_snapshot({"LONDON": [1, 5, 3, 5], "SCOTLAND": [1, 2, 3, 4]})["forecast_matrix"]
+        self.assertEqual(changed_slots(old, new), {"LONDON": range(1, 4), "WALES": range(4), "SCOTLAND": range(4)})
+        # a new time axis changes every slot
+        moved = make_snapshot({"LONDON": [2, 3, 4], "WALES": [2, 3, 4]}, first=1)["forecast_matrix"]
+        self.assertEqual(changed_slots(old, moved), {"LONDON": range(3), "WALES": range(3)})
+
+    async def test_only_affected_queries_are_evaluated(self):
+        minimiser = Minimiser()
+        minimiser.cache = Cache(1800)
+        minimiser.cache.cache = make_snapshot({"LONDON": [5, 1, 5, 5, 5, 5], "WALES": [5, 5, 5, 5, 5, 1]})
+        subscriptions = Subscriptions(minimiser)
+        london = {"location": "LONDON", "window_len": 0.5, "num_options": 1, "time_range": [0, 3]}
+        wales = {"location": "WALES", "window_len": 0.5, "num_options": 1, "time_range": [0, 3]}
+        subscription = await subscriptions.add([london, wales])
+        self.assertEqual(subscription.changes.get_nowait(),
+                         [(0, {'time': '+1', 'forecast': 1}), (1, {'time': '+5', 'forecast': 1})])
+
+        evaluate = mock.Mock(wraps=minimiser.optimal_time_windows)
+        with mock.patch.object(minimiser, "optimal_time_windows", evaluate):
+            # unchanged snapshot
+            await subscriptions.refresh()
+            # WALES changes, to no better half hour
+            minimiser.cache.publish(make_snapshot({"LONDON": [5, 1, 5, 5, 5, 5], "WALES": [5, 5, 6, 5, 5, 1]}))
+            await subscriptions.refresh()
+            self.assertEqual(evaluate.call_args_list, [mock.call([wales])])
+            self.assertTrue(subscription.changes.empty())
+            # LONDON changes
+            minimiser.cache.publish(make_snapshot({"LONDON": [5, 1, 5, 5, 0, 5], "WALES": [5, 5, 6, 5, 5, 1]}))
+            await subscriptions.refresh()
+            self.assertEqual(evaluate.call_args_list[-1], mock.call([london]))
+            self.assertEqual(subscription.changes.get_nowait(), [(0, {'time': '+4', 'forecast': 0})])
+
+        subscriptions.remove(subscription)
+        self.assertEqual(subscriptions.subscriptions, set())